@@ -3,13 +3,17 @@
 from .paths import DEP_PATH, ROOT, STOCKFISH_PATH 
 __all__ = ["DEP_PATH", "ROOT", "STOCKFISH_PATH"]
 from .evaluation import score_to_cp, classify_move, fmt_eval
-from .engine import Engine
-from .analysis import analyze_pgn_text, analyze_game
+from .engine import AsyncEngine, Engine, EngineFailure
+from .cache import EvalCache, GameCache
+from .pool import AsyncEnginePool, EnginePool
+from .analysis import analyze_pgn_text, analyze_game, analyze_game_iter, analyze_game_aiter, analyze_game_async, analyze_games
+from .batch import analyze_pgn_file
+from .coalesce import AnalysisCoalescer
 from .motifs import detect_simple_tactics
-from . import paths, evaluation, engine, analysis, motifs
+from . import paths, evaluation, engine, cache, pool, analysis, batch, coalesce, motifs
 from . import cli  # Import CLI module for command line interface
 __version__ = "0.1.0"  # Example version, update as needed
-__all__ += ["__version__", "cli", "paths", "evaluation", "engine", "analysis", "motifs"]
+__all__ += ["__version__", "cli", "paths", "evaluation", "engine", "cache", "pool", "analysis", "batch", "coalesce", "motifs"]
 # Ensure the paths are set up correctly
 # This is done in paths.py, but we can also ensure it here
 # if __name__ == "__main__":
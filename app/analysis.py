@@ -1,109 +1,777 @@
-from typing import List, Dict
+from typing import AsyncIterator, Iterable, Iterator, List, Dict, Optional, Tuple
 from .paths import DEP_PATH, STOCKFISH_PATH
+import asyncio
 import io
-import chess, chess.pgn
-from .engine import Engine
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+import chess, chess.engine, chess.pgn, chess.polyglot
+from .engine import AsyncEngine, Engine, DEFAULT_DEPTH, limit_dict
+from .pool import AsyncEnginePool, EnginePool
+from .cache import GameCache, game_key
+from .book import BOOK_LABEL, as_reader, book_prefix
+from .tablebase import as_tablebase, probe_lines
+from .hardware import available_cores
 from tqdm import tqdm
-from .evaluation import score_to_cp, classify_quality_extended, fmt_eval
+from .evaluation import score_to_cp, classify_move, classify_quality_extended, fmt_eval
 
-def analyze_pgn_text(pgn_text: str) -> List[Dict]:
+# Tiered mode: every position is searched at SHALLOW_DEPTH, then the positions
+# around critical plies are searched again at DEEP_DEPTH
+SHALLOW_DEPTH = 10
+DEEP_DEPTH = 25
+TIER_SWING_CP = 100          # cp change caused by the move
+TIER_VOLATILITY_CP = 150     # eval spread over the move and the reply
+TIER_LABELS = {"BLUNDER", "MISTAKE", "INACCURACY", "Miss", "Great", "Brilliant"}
+
+# With a user limit or game budget, deep positions get TIER_DEEP_FACTOR times
+# the user's limit, or share TIER_DEEP_SHARE of the budget
+TIER_DEEP_FACTOR = 4
+TIER_DEEP_SHARE = 0.3
+
+# Floors for per-position shares of a game budget (capped so they fit in it)
+MIN_PLY_NODES = 20000
+MIN_PLY_TIME = 0.05
+# Part of a game budget held back for re-searches (wider MultiPV, searchmoves)
+RESEARCH_RESERVE = 0.1
+
+# Moves played from a position with a single legal move skip the engine
+FORCED_LABEL = "Forced"
+# Once the previous position is a mate or beyond DECIDED_CP, a quick
+# DECIDED_NODES search is enough to follow the conversion
+DECIDED_CP = 1500
+DECIDED_NODES = 5000
+
+def read_first_game(pgn_text: str) -> chess.pgn.Game:
     game = chess.pgn.read_game(io.StringIO(pgn_text))
     if not game:
         raise ValueError("No valid game in PGN.")
-    return analyze_game(game), game
+    return game
 
-def analyze_game(game: chess.pgn.Game) -> List[Dict]:
-    from .motifs import detect_simple_tactics  # avoid circular imports
-    results: List[Dict] = []
-    board = game.board()
+def analyze_pgn_text(pgn_text: str, **options) -> List[Dict]:
+    game = read_first_game(pgn_text)
+    return analyze_game(game, **options), game
+
+# Use the caller's engine, borrow one from the pool, or spawn a private one
+@contextmanager
+def _engine_for(engine: Optional[Engine], pool: Optional[EnginePool]):
+    if engine is not None:
+        yield engine
+    elif pool is not None:
+        with pool.engine() as eng:
+            yield eng
+    else:
+        eng = Engine().start()
+        try:
+            yield eng
+        finally:
+            eng.stop()
 
-    eng = Engine().start()
+# P0..Pn, each with the game's move stack so the engine sees repetitions
+def _mainline_boards(game: chess.pgn.Game) -> List[chess.Board]:
+    boards = [game.board()]
+    for move in game.mainline_moves():
+        board = boards[-1].copy()
+        board.push(move)
+        boards.append(board)
+    return boards
+
+def analyze_game(game: chess.pgn.Game, **options) -> List[Dict]:
+    return list(analyze_game_iter(game, **options))
+
+# Yields each ply's result as soon as the positions before and after it are known
+def analyze_game_iter(game: chess.pgn.Game, engine: Optional[Engine] = None, pool: Optional[EnginePool] = None,
+                      parallel: bool = False, progress: bool = True, book=None, tablebase=None,
+                      pgn_eval_depth: Optional[int] = None, tiered: bool = False,
+                      shallow_depth: int = SHALLOW_DEPTH, deep_depth: int = DEEP_DEPTH,
+                      limit: Optional[chess.engine.Limit] = None,
+                      budget: Optional[chess.engine.Limit] = None,
+                      searchmoves: bool = False, game_cache: Optional[GameCache] = None) -> Iterator[Dict]:
+    review = _Review(game, engine, pool, book=book, tablebase=tablebase, pgn_eval_depth=pgn_eval_depth,
+                     tiered=tiered, shallow_depth=shallow_depth, deep_depth=deep_depth, limit=limit,
+                     budget=budget, searchmoves=searchmoves, game_cache=game_cache)
+    if review.cached is not None:
+        yield from review.cached
+        return
+    searches = _iter_searches(review.boards, review.wanted, review.limits, engine, pool, parallel, progress,
+                              review.game_key, decided=True, played=review.played, research=review.research)
     try:
-        start_info = eng.analyse_safe(board, depth=10)
-        prev_cp = score_to_cp(start_info["score"])
-
-        ply = 1
-        moves = list(game.mainline_moves())
-        for move in tqdm(moves, desc="Analyzing moves", unit="move"):
-            white_to_move = board.turn == chess.WHITE
-            was_capture = board.is_capture(move)
-
-            board_before = board.copy(stack=False)
-            lines = eng.best_lines(board, multipv=3)
-            best_move = None
-            if lines and "pv" in lines[0] and lines[0]["pv"]:
-                best_move = lines[0]["pv"][0]
-
-            san = board.san(move)
-            board.push(move)
-
-            after_info = eng.analyse_safe(board, depth=10)
-            after_cp = score_to_cp(after_info["score"])
-
-            label = classify_quality_extended(
-                before_cp=prev_cp,
-                after_cp=after_cp,
-                white_to_move=white_to_move,
-                played_move=move,
-                board_before=board_before,
-                premove_lines=lines
-            )
-
-            motifs = detect_simple_tactics(board, just_played_was_capture=was_capture)
-
-            results.append({
-                "ply": ply,
-                "san": san,
-                "uci": move.uci(),
-                "label": label,
-                "cp_loss": abs(prev_cp - after_cp),
-                "eval_before": prev_cp,
-                "eval_after": after_cp,
-                "best_move": best_move.uci() if best_move else None,
-                "motifs": motifs,
-                "white_move": white_to_move
-            })
-
-            prev_cp = after_cp
-            ply += 1
-
-        return results
+        if review.tiered:
+            deep = review.replan(searches)  # cheap first pass over every position
+            searches.close()
+            searches = _iter_searches(review.boards, deep, review.limits, engine, pool, parallel, progress,
+                                      review.game_key, played=review.played, research=review.research)
+        for ply in range(1, len(review.moves) + 1):
+            while review.missing(ply):
+                review.add(*next(searches))
+            request = review.widen(ply)
+            if request:
+                review.add_wider(*searches.send(request))
+            yield review.finish(ply)
     finally:
-        eng.stop()
+        searches.close()
+    review.save()
 
-def format_results(results: List[Dict], game: chess.pgn.Game = None) -> str:
-    from collections import Counter
+# Analyze a batch of games together, searching every distinct position once.
+# The games' engine positions are pooled by Zobrist key (the first game to
+# reach a position supplies its move stack), searched with a single line on
+# the pool, widened where some game's move needs it (see _lines_needed), and
+# each game's plies are then classified from the shared lines.
+# Tiered mode, game budgets and searchmoves depend on the game around a
+# position and are not available here.
+def analyze_games(games: List[chess.pgn.Game], engine: Optional[Engine] = None,
+                  pool: Optional[EnginePool] = None, parallel: bool = True, progress: bool = True,
+                  book=None, tablebase=None, pgn_eval_depth: Optional[int] = None,
+                  limit: Optional[chess.engine.Limit] = None) -> List[List[Dict]]:
+    plans = [_plan(game, book, tablebase, pgn_eval_depth) for game in games]
+    unique: List[chess.Board] = []
+    index: Dict[int, int] = {}      # Zobrist key -> position in `unique`
+    owners: List[Dict[int, int]] = []  # per game: position index -> position in `unique`
+    for boards, moves, n_book, lines, wanted, forced in plans:
+        owner = {}
+        for i in sorted(wanted):
+            key = chess.polyglot.zobrist_hash(boards[i])
+            if key not in index:
+                index[key] = len(unique)
+                unique.append(boards[i])
+            owner[i] = index[key]
+        owners.append(owner)
+
+    search_limit = limit or chess.engine.Limit(depth=DEFAULT_DEPTH)
+    limits = {u: search_limit for u in range(len(unique))}
+    run_key = object()
+    found = dict(_iter_searches(unique, {u: 1 for u in limits}, limits, engine, pool, parallel, progress, run_key))
+
+    wider: Dict[int, int] = {}
+    for plan, owner in zip(plans, owners):
+        boards, moves, n_book, _, wanted, _ = plan
+        lines = _shared_lines(plan, owner, found)
+        for ply in range(n_book + 1, len(moves) + 1):
+            more = _lines_needed(ply, boards, moves, lines, wanted)
+            if more:
+                u = owner[ply - 1]
+                wider[u] = max(wider.get(u, 0), more)
+    found.update(_iter_searches(unique, wider, limits, engine, pool, parallel, progress, run_key))
+
+    results = []
+    for plan, owner in zip(plans, owners):
+        boards, moves, n_book, _, wanted, forced = plan
+        lines = _shared_lines(plan, owner, found)
+        game_limits = {i: search_limit for i in wanted}
+        results.append([_ply_from_plan(ply, boards, moves, n_book, lines, game_limits, forced)
+                        for ply in range(1, len(moves) + 1)])
+    return results
+
+# One game's lines: its own (tablebase, embedded evals), the shared searches
+# of its engine positions, and the forced positions carried from those
+def _shared_lines(plan, owner: Dict[int, int], found: Dict[int, List[Dict]]) -> Dict[int, List[Dict]]:
+    _, moves, _, own, _, forced = plan
+    lines = {**own, **{i: found[u] for i, u in owner.items()}}
+    _carry_forced(range(len(moves)), forced, moves, lines)
+    return lines
+
+# Async counterpart of analyze_game_iter. With an AsyncEngine or AsyncEnginePool
+# the searches run natively on the event loop; otherwise the sync generator is
+# driven from a worker thread.
+async def analyze_game_aiter(game: chess.pgn.Game, **options) -> AsyncIterator[Dict]:
+    if isinstance(options.get("engine"), AsyncEngine) or isinstance(options.get("pool"), AsyncEnginePool):
+        async for result in _analyze_game_native(game, **options):
+            yield result
+        return
+
+    it = analyze_game_iter(game, **options)
+    done = object()
+    try:
+        while True:
+            result = await asyncio.to_thread(next, it, done)
+            if result is done:
+                return
+            yield result
+    finally:
+        await asyncio.to_thread(it.close)
+
+async def analyze_game_async(game: chess.pgn.Game, **options) -> List[Dict]:
+    return [result async for result in analyze_game_aiter(game, **options)]
+
+async def _analyze_game_native(game: chess.pgn.Game, engine: Optional[AsyncEngine] = None,
+                               pool: Optional[AsyncEnginePool] = None, parallel: bool = False,
+                               progress: bool = True, **settings) -> AsyncIterator[Dict]:
+    review = _Review(game, engine, pool, **settings)
+    if review.cached is not None:
+        for result in review.cached:
+            yield result
+        return
+    searches = _aiter_searches(review.boards, review.wanted, review.limits, engine, pool, parallel, progress,
+                               review.game_key, decided=True, played=review.played, research=review.research)
+    try:
+        if review.tiered:
+            deep = review.replan([item async for item in searches])
+            await searches.aclose()
+            searches = _aiter_searches(review.boards, deep, review.limits, engine, pool, parallel, progress,
+                                       review.game_key, played=review.played, research=review.research)
+        for ply in range(1, len(review.moves) + 1):
+            while review.missing(ply):
+                review.add(*await searches.__anext__())
+            request = review.widen(ply)
+            if request:
+                review.add_wider(*await searches.asend(request))
+            yield review.finish(ply)
+    finally:
+        await searches.aclose()
+    review.save()
+
+# One analysis run of a game, shared by the sync and async drivers: the plan,
+# the lines found so far and the results. The drivers only run the searches
+# it asks for (review.wanted first, then what replan and widen return).
+class _Review:
+    def __init__(self, game: chess.pgn.Game, engine=None, pool=None, book=None, tablebase=None,
+                 pgn_eval_depth: Optional[int] = None, tiered: bool = False,
+                 shallow_depth: int = SHALLOW_DEPTH, deep_depth: int = DEEP_DEPTH,
+                 limit: Optional[chess.engine.Limit] = None, budget: Optional[chess.engine.Limit] = None,
+                 searchmoves: bool = False, game_cache: Optional[GameCache] = None):
+        self.game_cache = game_cache
+        self.key = analysis_key(game, engine, pool, book=book, tablebase=tablebase, pgn_eval_depth=pgn_eval_depth,
+                                tiered=tiered, shallow_depth=shallow_depth, deep_depth=deep_depth, limit=limit,
+                                budget=budget, searchmoves=searchmoves) if game_cache is not None else None
+        self.cached = game_cache.get(self.key) if self.key else None
+        if self.cached is not None:
+            return
+        self.tiered = tiered
+        self.deep_depth = deep_depth
+        self.limit = limit
+        self.budget = budget
+        self.results: List[Dict] = []
+        self.boards, self.moves, self.n_book, self.lines, wanted, self.forced = \
+            _plan(game, book, tablebase, pgn_eval_depth)
+        if tiered and budget is not None:
+            budget = _scale_limit(budget, 1 - TIER_DEEP_SHARE)  # the rest goes to the deep pass
+        # limits of the searches, and of the re-searches of the same positions
+        self.limits, self.research = _position_limits(self.boards, wanted,
+                                                      shallow_depth if tiered else DEFAULT_DEPTH, limit, budget)
+        self.full, self.wanted = _lazy_multipv(wanted, tiered)
+        # one key per analysis run: engines keep their hash between its plies and
+        # get ucinewgame when they move on to another game
+        self.game_key = object()
+        # with searchmoves, pre-move index -> line of the played move
+        self.played = {} if searchmoves else None
+
+    def add(self, i: int, found: List[Dict]):
+        self.lines[i] = found
+
+    # Lines of a wider search of position i. Under a game budget it ran at the
+    # smaller re-search share, so the main search's line stays first and the
+    # wider one only supplies the alternatives.
+    def add_wider(self, i: int, found: List[Dict]):
+        if self.research is self.limits:
+            self.lines[i] = found
+            return
+        main = self.lines[i][0]
+        best = main["pv"][0] if main.get("pv") else None
+        others = [line for line in found if not line.get("pv") or line["pv"][0] != best]
+        self.lines[i] = [main, *others][:max(len(found), 1)]
+
+    # Tiered mode: take the first pass (index, lines) pairs and return the
+    # positions around critical plies, whose lines are dropped for a deep search
+    def replan(self, first_pass: Iterable[Tuple[int, List[Dict]]]) -> Dict[int, int]:
+        self.lines.update(first_pass)
+        _carry_forced(range(len(self.moves)), self.forced, self.moves, self.lines)
+        deep = _critical_positions(self.boards, self.moves, self.n_book, self.lines, self.wanted,
+                                   self.forced, self.played)
+        for i in [*deep, *self.forced]:
+            self.lines.pop(i, None)
+            if self.played is not None:
+                self.played.pop(i, None)
+        limit = _deep_limit(self.limit, self.deep_depth) if self.limit else None
+        budget = _scale_limit(self.budget, TIER_DEEP_SHARE) if self.budget is not None else None
+        limits, research = _position_limits(self.boards, deep, self.deep_depth, limit, budget)
+        self.limits.update(limits)
+        self.research.update(research)
+        return deep
+
+    # positions `ply` is classified from (book plies only need the start position)
+    def _needed(self, ply: int) -> Tuple[int, ...]:
+        return (0,) if ply <= self.n_book else (ply - 1, ply)
+
+    # searched positions `ply` still waits for
+    def missing(self, ply: int) -> List[int]:
+        sources = (_forced_source(i, self.forced) for i in self._needed(ply))
+        return [i for i in sources if i not in self.lines]
+
+    # (index, multipv) of the wider search `ply` needs, or None
+    def widen(self, ply: int) -> Optional[Tuple[int, int]]:
+        _carry_forced(self._needed(ply), self.forced, self.moves, self.lines)
+        if ply <= self.n_book:
+            return None
+        more = _lines_needed(ply, self.boards, self.moves, self.lines, self.full, self.played)
+        return (ply - 1, more) if more else None
+
+    def finish(self, ply: int) -> Dict:
+        self.results.append(_ply_from_plan(ply, self.boards, self.moves, self.n_book, self.lines,
+                                           self.limits, self.forced, self.played))
+        return self.results[-1]
+
+    def save(self):
+        if self.key:
+            self.game_cache.put(self.key, self.results)
+
+# Identifies the results of analyzing `game` with these settings (the keyword
+# options of analyze_game_iter that shape its results), or None when a
+# setting cannot be keyed (an open book reader or tablebase object)
+def analysis_key(game: chess.pgn.Game, engine=None, pool=None, **settings) -> Optional[str]:
+    config: Dict = {"depth": DEFAULT_DEPTH}
+    for name, value in settings.items():
+        if isinstance(value, chess.engine.Limit):
+            value = limit_dict(value)
+        elif isinstance(value, Path):
+            value = str(value)
+        elif not isinstance(value, (str, int, float, bool, type(None))):
+            return None
+        config[name] = value
+    if settings.get("pgn_eval_depth") is not None:
+        # trusted [%eval] comments replace searches, so they are part of the key
+        config["pgn_evals"] = [[str(node.eval()), node.eval_depth()] for node in [game, *game.mainline()]]
+    return game_key(game, _engine_name(engine, pool), config)
+
+# Engine build the results come from: the id name of a started engine, else
+# the binary's file name
+def _engine_name(engine, pool) -> str:
+    if engine is not None:
+        return engine.name or Path(engine.path).name
+    if pool is not None:
+        return pool.engines[0].name if pool.engines else Path(str(pool.path)).name
+    return Path(str(STOCKFISH_PATH)).name
+
+# Work out where each position's lines come from. Returns the boards, the
+# mainline moves, the number of leading book moves, the lines already known
+# (tablebase, embedded evals), the positions left for the engine
+# (index -> MultiPV) and the forced positions (a single legal move).
+def _plan(game: chess.pgn.Game, book, tablebase, pgn_eval_depth: Optional[int]):
+    boards = _mainline_boards(game)
+    moves = list(game.mainline_moves())
+
+    # Book moves skip the engine and carry the start position's eval forward
+    n_book = book_prefix(as_reader(book), boards[0], moves) if book is not None else 0
+
+    # Each remaining position is searched once: its lines give eval_before
+    # of the move played from it and eval_after of the move leading to it.
+    # The final position only needs its score.
+    wanted = {i: 3 if i < len(moves) else 1 for i in range(n_book, len(boards))}
+    wanted.setdefault(0, 3 if moves else 1)
+
+    # Endgame positions inside the tablebase get their lines from the tables
+    lines: Dict[int, List[Dict]] = {}
+    if tablebase is not None:
+        tb = as_tablebase(tablebase)
+        for i, multipv in list(wanted.items()):
+            played = moves[i] if i < len(moves) else None
+            tb_lines = probe_lines(tb, boards[i], multipv, prefer=played)
+            if tb_lines:
+                lines[i] = tb_lines
+                del wanted[i]
+
+    # Trust [%eval] annotations searched at least pgn_eval_depth deep (a missing
+    # depth counts as 0); they carry no best move, so only the score is reused
+    if pgn_eval_depth is not None:
+        nodes = [game, *game.mainline()]
+        for i in list(wanted):
+            score, depth = nodes[i].eval(), nodes[i].eval_depth()
+            if score is not None and (depth or 0) >= pgn_eval_depth:
+                lines[i] = [{"score": score, "depth": depth}] if depth is not None else [{"score": score}]
+                del wanted[i]
+
+    # A position with one legal move is worth exactly the position after it,
+    # so it is never searched (see _carry_forced). The final position has no
+    # move to carry from and stays.
+    forced = {i for i in wanted if i < len(moves) and boards[i].legal_moves.count() == 1}
+    for i in forced:
+        del wanted[i]
+
+    return boards, moves, n_book, lines, wanted, forced
+
+# First position at or after i whose lines come from a search or a probe
+def _forced_source(i: int, forced) -> int:
+    while i in forced:
+        i += 1
+    return i
+
+# Give the forced positions among `indices` the score of the position after
+# them, with the only move as their pv. The source lines must be known.
+def _carry_forced(indices: Iterable[int], forced, moves: List[chess.Move], lines: Dict[int, List[Dict]]):
+    for i in indices:
+        if i not in forced or i in lines:
+            continue
+        src = _forced_source(i, forced)
+        for k in range(src - 1, i - 1, -1):
+            lines[k] = [{"score": lines[k + 1][0]["score"], "pv": [moves[k]]}]
 
+# Positions are first searched with a single line; the extra MultiPV lines
+# only matter for moves that are not already bad (see _lines_needed).
+# Tiered mode picks its deep positions from labels, so it searches them all
+# up front. Returns the full MultiPV per position and what to search first.
+def _lazy_multipv(wanted: Dict[int, int], tiered: bool) -> Tuple[Dict[int, int], Dict[int, int]]:
+    if tiered:
+        return {}, wanted
+    return dict(wanted), {i: 1 for i in wanted}
+
+# Lines the position before `ply` still needs for classify_quality_extended:
+# none for a bad move, two for the "only move" check when the best move was
+# played, three to rank any other move. 0 when the lines at hand suffice.
+def _lines_needed(ply: int, boards: List[chess.Board], moves: List[chess.Move],
+                  lines: Dict[int, List[Dict]], full: Dict[int, int], played=None) -> int:
+    i = ply - 1
+    if i not in full:
+        return 0
+    have = lines[i]
+    before_cp = score_to_cp(have[0]["score"])
+    after_cp = score_to_cp(_after_lines(ply, lines, played)[0]["score"])
+    label, _ = classify_move(before_cp, after_cp, boards[i].turn == chess.WHITE)
+    if label != "GOOD":
+        return 0
+    pv = have[0].get("pv")
+    k = 2 if pv and pv[0] == moves[i] else 3
+    k = min(k, full[i], boards[i].legal_moves.count())
+    return k if len(have) < k else 0
+
+# Engine-searched positions around plies whose shallow result looks critical:
+# a big cp swing, a label worth confirming, or a volatile eval around the move
+def _critical_positions(boards: List[chess.Board], moves: List[chess.Move], n_book: int,
+                        lines: Dict[int, List[Dict]], wanted: Dict[int, int], forced=(),
+                        played=None) -> Dict[int, int]:
+    evals = {i: score_to_cp(li[0]["score"]) for i, li in lines.items()}
+    deep: Dict[int, int] = {}
+    for ply in range(n_book + 1, len(moves) + 1):
+        r = _ply_from_plan(ply, boards, moves, n_book, lines, forced=forced, played=played)
+        window = [evals[i] for i in (ply - 1, ply, ply + 1) if i in evals]
+        if (r["cp_loss"] >= TIER_SWING_CP or r["label"] in TIER_LABELS
+                or max(window) - min(window) >= TIER_VOLATILITY_CP):
+            for i in (ply - 1, ply):
+                if i in wanted:
+                    deep[i] = wanted[i]
+    return deep
+
+def _ply_from_plan(ply: int, boards: List[chess.Board], moves: List[chess.Move], n_book: int,
+                   lines: Dict[int, List[Dict]], limits: Optional[Dict[int, chess.engine.Limit]] = None,
+                   forced=(), played=None) -> Dict:
+    move = moves[ply - 1]
+    if ply <= n_book:
+        carried = [{"score": lines[0][0]["score"], "pv": [move]}]
+        result = _ply_result(ply, boards[ply - 1], move, carried, carried, label=BOOK_LABEL)
+        used = None
+    else:
+        label = FORCED_LABEL if ply - 1 in forced else None
+        result = _ply_result(ply, boards[ply - 1], move, lines[ply - 1], _after_lines(ply, lines, played),
+                             label=label)
+        used = (limits or {}).get(ply - 1)
+    # search limit of the pre-move position (None when no engine search was needed)
+    result["limit"] = limit_dict(used) if used else None
+    return result
+
+# Lines giving eval_after of `ply`: the played move's line from the pre-move
+# search when it was scored there (searchmoves), else the position after it
+def _after_lines(ply: int, lines: Dict[int, List[Dict]], played=None) -> List[Dict]:
+    if played and ply - 1 in played:
+        return [played[ply - 1]]
+    return lines[ply]
+
+def _played_line(found: List[Dict], move: chess.Move) -> Optional[Dict]:
+    for line in found:
+        if line.get("pv") and line["pv"][0] == move:
+            return line
+    return None
+
+# Record the line of the move played from position i in `played` when the
+# search found it among its MultiPV lines. Returns the move when it still
+# needs a search restricted to it with UCI searchmoves (done once), else None.
+def _unscored_move(boards: List[chess.Board], i: int, found: List[Dict], played) -> Optional[chess.Move]:
+    if played is None or i + 1 >= len(boards):
+        return None
+    move = boards[i + 1].peek()
+    line = _played_line(found, move)
+    if line is not None:
+        played[i] = line
+        return None
+    return None if i in played else move
+
+def _score_played(eng: Engine, boards: List[chess.Board], i: int, found: List[Dict],
+                  limit: chess.engine.Limit, game_key: object, played):
+    move = _unscored_move(boards, i, found, played)
+    if move is not None:
+        played[i] = eng.best_lines(boards[i], multipv=1, limit=limit, game=game_key, root_moves=[move])[0]
+
+async def _ascore_played(eng: AsyncEngine, boards: List[chess.Board], i: int, found: List[Dict],
+                         limit: chess.engine.Limit, game_key: object, played):
+    move = _unscored_move(boards, i, found, played)
+    if move is not None:
+        played[i] = (await eng.best_lines(boards[i], multipv=1, limit=limit, game=game_key,
+                                          root_moves=[move]))[0]
+
+# Per-position search limits: a per-game budget split by position weight,
+# a fixed per-position limit, or plain depth. Returns the limits of the
+# searches and of re-searches of the same positions (wider MultiPV,
+# searchmoves); under a budget those share the RESEARCH_RESERVE, two each.
+def _position_limits(boards: List[chess.Board], wanted: Dict[int, int], depth: int,
+                     limit: Optional[chess.engine.Limit] = None,
+                     budget: Optional[chess.engine.Limit] = None
+                     ) -> Tuple[Dict[int, chess.engine.Limit], Dict[int, chess.engine.Limit]]:
+    if budget is None:
+        # re-searches run at the same limits, shrunk together by _decided_limit
+        limits = {i: limit or chess.engine.Limit(depth=depth) for i in wanted}
+        return limits, limits
+    if budget.nodes is None and budget.time is None:
+        raise ValueError("A game budget needs nodes or time")
+    weights = {i: _position_weight(boards[i]) for i in wanted}
+    return (_split_budget(weights, _scale_limit(budget, 1 - RESEARCH_RESERVE)),
+            _split_budget(weights, _scale_limit(budget, RESEARCH_RESERVE / 2)))
+
+# Every position gets the floor (lowered so the floors alone fit), the rest
+# of the budget goes by weight, so the limits add up to the budget
+def _split_budget(weights: Dict[int, float], budget: chess.engine.Limit) -> Dict[int, chess.engine.Limit]:
+    if not weights:
+        return {}
+    total = sum(weights.values())
+
+    def shares(amount: float, floor: float) -> Dict[int, float]:
+        floor = min(floor, amount / len(weights))
+        rest = amount - floor * len(weights)
+        return {i: floor + rest * w / total for i, w in weights.items()}
+
+    nodes = shares(budget.nodes, MIN_PLY_NODES) if budget.nodes else {}
+    times = shares(budget.time, MIN_PLY_TIME) if budget.time else {}
+    return {i: chess.engine.Limit(nodes=max(1, int(nodes[i])) if nodes else None, time=times.get(i))
+            for i in weights}
+
+# `limit` with its node and time allowances scaled by `factor`
+def _scale_limit(limit: chess.engine.Limit, factor: float) -> chess.engine.Limit:
+    return chess.engine.Limit(nodes=int(limit.nodes * factor) if limit.nodes else None,
+                              time=limit.time * factor if limit.time else None, depth=limit.depth)
+
+# Tiered mode's deep search under a user limit: TIER_DEEP_FACTOR times its
+# nodes and time, and at least deep_depth for a depth limit
+def _deep_limit(limit: chess.engine.Limit, deep_depth: int) -> chess.engine.Limit:
+    deep = _scale_limit(limit, TIER_DEEP_FACTOR)
+    if deep.depth:
+        deep.depth = max(deep.depth, deep_depth)
+    return deep
+
+# Relative search effort for a position: forced and quiet positions get
+# little, wide positions with checks and captures get more
+def _position_weight(board: chess.Board) -> float:
+    legal = list(board.legal_moves)
+    if len(legal) <= 1:
+        return 0.1
+    weight = 0.5 + min(len(legal), 40) / 40
+    if board.is_check():
+        weight += 0.5
+    weight += min(0.5, 0.1 * sum(1 for m in legal if board.is_capture(m)))
+    return weight
+
+# Shrink position i's limits (searches and re-searches) to DECIDED_NODES when
+# the previous position was searched just before it (`found`) and the game is
+# already decided there
+def _decided_limit(i: int, found: Optional[List[Dict]], limits: Dict[int, chess.engine.Limit],
+                   research: Dict[int, chess.engine.Limit]):
+    if not found or i - 1 not in limits or abs(score_to_cp(found[0]["score"])) < DECIDED_CP:
+        return
+    for table in (limits, research):
+        if (table[i].nodes or DECIDED_NODES + 1) > DECIDED_NODES:
+            table[i] = chess.engine.Limit(nodes=DECIDED_NODES)
+
+# Search the wanted positions (index -> MultiPV) one after another on a single
+# engine, or fanned out over the pool's engines in parallel mode.
+# With `decided`, sequential searches drop to DECIDED_NODES once the game is
+# decided (parallel searches are all queued up front and keep their limits).
+# Yields (index, lines) in position order; a (index, multipv) sent in asks
+# for a wider search of an already yielded position, answered by the next yield.
+# Wider and searchmoves searches run at the `research` limits (default: limits).
+def _iter_searches(boards: List[chess.Board], wanted: Dict[int, int], limits: Dict[int, chess.engine.Limit],
+                   engine: Optional[Engine], pool: Optional[EnginePool], parallel: bool,
+                   progress: bool, game_key: object = None, decided: bool = False,
+                   played=None, research: Optional[Dict[int, chess.engine.Limit]] = None
+                   ) -> Iterator[Tuple[int, List[Dict]]]:
+    if not wanted:
+        return
+    research = research or limits
+    order = tqdm(sorted(wanted), desc="Analyzing moves", unit="pos", disable=not progress)
+    if not (parallel and engine is None):
+        with _engine_for(engine, pool) as eng:
+            found = None
+            for i in order:
+                if decided:
+                    _decided_limit(i, found, limits, research)
+                found = eng.best_lines(boards[i], multipv=wanted[i], limit=limits[i], game=game_key)
+                _score_played(eng, boards, i, found, research[i], game_key, played)
+                request = yield i, found
+                while request:
+                    j, multipv = request
+                    wider = eng.best_lines(boards[j], multipv=multipv, limit=research[j], game=game_key)
+                    _score_played(eng, boards, j, wider, research[j], game_key, played)
+                    request = yield j, wider
+        return
+
+    own_pool = pool is None
+    if own_pool:
+        # one single-threaded engine per allotted core
+        pool = EnginePool(size=available_cores()).start()
+    ex = ThreadPoolExecutor(max_workers=pool.size)
+    try:
+        def search(i: int, multipv: int, limit: chess.engine.Limit) -> List[Dict]:
+            with pool.engine() as eng:
+                found = eng.best_lines(boards[i], multipv=multipv, limit=limit, game=game_key)
+                _score_played(eng, boards, i, found, research[i], game_key, played)
+                return found
+
+        futures = {i: ex.submit(search, i, wanted[i], limits[i]) for i in sorted(wanted)}
+        for i in order:
+            request = yield i, futures[i].result()
+            while request:
+                j, multipv = request
+                request = yield j, search(j, multipv, research[j])
+    finally:
+        ex.shutdown(cancel_futures=True)
+        if own_pool:
+            pool.stop()
+
+@asynccontextmanager
+async def _async_engine_for(engine: Optional[AsyncEngine], pool: Optional[AsyncEnginePool]):
+    if engine is not None:
+        yield engine
+    elif pool is not None:
+        async with pool.engine() as eng:
+            yield eng
+    else:
+        async with AsyncEngine() as eng:
+            yield eng
+
+# _iter_searches on the event loop; parallel mode runs one task per position
+# and the pool's queue bounds how many search at once
+async def _aiter_searches(boards: List[chess.Board], wanted: Dict[int, int], limits: Dict[int, chess.engine.Limit],
+                          engine: Optional[AsyncEngine], pool: Optional[AsyncEnginePool], parallel: bool,
+                          progress: bool, game_key: object = None,
+                          decided: bool = False, played=None,
+                          research: Optional[Dict[int, chess.engine.Limit]] = None
+                          ) -> AsyncIterator[Tuple[int, List[Dict]]]:
+    if not wanted:
+        return
+    research = research or limits
+    order = tqdm(sorted(wanted), desc="Analyzing moves", unit="pos", disable=not progress)
+    if not (parallel and engine is None and pool is not None):
+        async with _async_engine_for(engine, pool) as eng:
+            found = None
+            for i in order:
+                if decided:
+                    _decided_limit(i, found, limits, research)
+                found = await eng.best_lines(boards[i], multipv=wanted[i], limit=limits[i], game=game_key)
+                await _ascore_played(eng, boards, i, found, research[i], game_key, played)
+                request = yield i, found
+                while request:
+                    j, multipv = request
+                    wider = await eng.best_lines(boards[j], multipv=multipv, limit=research[j], game=game_key)
+                    await _ascore_played(eng, boards, j, wider, research[j], game_key, played)
+                    request = yield j, wider
+        return
+
+    async def search(i: int, multipv: int, limit: chess.engine.Limit) -> List[Dict]:
+        async with pool.engine() as eng:
+            found = await eng.best_lines(boards[i], multipv=multipv, limit=limit, game=game_key)
+            await _ascore_played(eng, boards, i, found, research[i], game_key, played)
+            return found
+
+    tasks = {i: asyncio.ensure_future(search(i, wanted[i], limits[i])) for i in sorted(wanted)}
+    try:
+        for i in order:
+            request = yield i, await tasks[i]
+            while request:
+                j, multipv = request
+                request = yield j, await search(j, multipv, research[j])
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+# Classify one move from the lines of the positions before and after it
+def _ply_result(ply: int, board_before: chess.Board, move: chess.Move, lines: List[Dict], after_lines: List[Dict],
+                label: Optional[str] = None) -> Dict:
+    from .motifs import detect_simple_tactics  # avoid circular imports
+    white_to_move = board_before.turn == chess.WHITE
+    was_capture = board_before.is_capture(move)
+    before_cp = score_to_cp(lines[0]["score"])
+    after_cp = score_to_cp(after_lines[0]["score"])
+
+    best_move = None
+    if lines and "pv" in lines[0] and lines[0]["pv"]:
+        best_move = lines[0]["pv"][0]
+
+    if label is None:
+        label = classify_quality_extended(
+            before_cp=before_cp,
+            after_cp=after_cp,
+            white_to_move=white_to_move,
+            played_move=move,
+            board_before=board_before,
+            premove_lines=lines
+        )
+
+    board_after = board_before.copy(stack=False)
+    board_after.push(move)
+    motifs = detect_simple_tactics(board_after, just_played_was_capture=was_capture)
+
+    return {
+        "ply": ply,
+        "san": board_before.san(move),
+        "uci": move.uci(),
+        "label": label,
+        "cp_loss": abs(before_cp - after_cp),
+        "eval_before": before_cp,
+        "eval_after": after_cp,
+        "best_move": best_move.uci() if best_move else None,
+        "motifs": motifs,
+        "white_move": white_to_move
+    }
+
+def format_results(results: Iterable[Dict], game: chess.pgn.Game = None) -> str:
+    return "\n".join(iter_format_results(results, game))
+
+# Yields report lines as results arrive, so a stream from analyze_game_iter
+# can be printed ply by ply; the summaries follow once the stream ends.
+def iter_format_results(results: Iterable[Dict], game: chess.pgn.Game = None) -> Iterator[str]:
     white_name = game.headers.get("White", "White") if game else "White"
     black_name = game.headers.get("Black", "Black") if game else "Black"
 
     white_labels = []
     black_labels = []
 
-    lines = ["\nANALYSIS RESULTS", "=" * 60]
+    yield "\nANALYSIS RESULTS"
+    yield "=" * 60
     for r in results:
-        move_num = (r["ply"] + 1) // 2
-        side = "W" if r["white_move"] else "B"
-        label = r["label"]
-        cp_loss = r["cp_loss"]
-        entry = f"{label}"
-        if cp_loss > 10:
-            entry += f" (-{cp_loss}cp)"
-        if r["motifs"]:
-            entry += " [" + ", ".join(r["motifs"]) + "]"
-        if label in {"BLUNDER", "MISTAKE", "INACCURACY", "Miss"} and r["best_move"]:
-            entry += f" | Better: {r['best_move']}"
-        lines.append(f"{move_num:2d}.{side} {r['san']:>6} | {entry}")
+        yield format_ply(r)
 
         if r["white_move"]:
-            white_labels.append(label)
+            white_labels.append(r["label"])
         else:
-            black_labels.append(label)
+            black_labels.append(r["label"])
 
-    def summarize(player: str, labels: List[str]) -> str:
-        c = Counter(labels)
-        good = sum(1 for lbl in labels if lbl.lower() == "good")
-        return f"""
+    yield ""
+    yield "=" * 60
+    yield _summarize(white_name, white_labels)
+    yield _summarize(black_name, black_labels)
+
+def format_ply(r: Dict) -> str:
+    move_num = (r["ply"] + 1) // 2
+    side = "W" if r["white_move"] else "B"
+    label = r["label"]
+    cp_loss = r["cp_loss"]
+    entry = f"{label}"
+    if cp_loss > 10:
+        entry += f" (-{cp_loss}cp)"
+    if r["motifs"]:
+        entry += " [" + ", ".join(r["motifs"]) + "]"
+    if label in {"BLUNDER", "MISTAKE", "INACCURACY", "Miss"} and r["best_move"]:
+        entry += f" | Better: {r['best_move']}"
+    return f"{move_num:2d}.{side} {r['san']:>6} | {entry}"
+
+def _summarize(player: str, labels: List[str]) -> str:
+    from collections import Counter
+    c = Counter(labels)
+    good = sum(1 for lbl in labels if lbl.lower() == "good")
+    return f"""
 ♟ {player.upper()} MOVE SUMMARY
 -----------------------------
 Brilliant:   {c['Brilliant']:2d}
@@ -111,14 +779,10 @@ Great:       {c['Great']:2d}
 Best:        {c['Best']:2d}
 Excellent:   {c['Excellent']:2d}
 Good:        {good:2d}
+Book:        {c['Book']:2d}
+Forced:      {c['Forced']:2d}
 Inaccuracy:  {c['INACCURACY']:2d}
 Mistake:     {c['MISTAKE']:2d}
 Blunder:     {c['BLUNDER']:2d}
 Miss:        {c['Miss']:2d}
 """
-
-    lines += ["", "=" * 60,
-              summarize(white_name, white_labels),
-              summarize(black_name, black_labels)]
-
-    return "\n".join(lines)
@@ -0,0 +1,337 @@
+# app/batch.py
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.util import Finalize
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, Sequence, TextIO, Tuple
+import chess, chess.pgn
+from .paths import STOCKFISH_PATH
+from .engine import Engine
+from .pool import EnginePool
+from .cache import EvalCache
+from .hardware import engine_config
+
+# headers copied into each per-game record
+RECORD_HEADERS = ("Event", "Site", "Date", "White", "Black", "Result", "WhiteElo", "BlackElo", "ECO", "TimeControl")
+
+# Dedup mode plans this many games at a time; options it passes on to analyze_games
+DEDUP_CHUNK = 256
+DEDUP_OPTIONS = ("book", "tablebase", "pgn_eval_depth", "limit")
+
+# Yield (index, offset, headers) for every game without parsing its moves,
+# from the handle's current position (game number `index`)
+def iter_game_offsets(handle: TextIO, index: int = 0) -> Iterator[Tuple[int, int, chess.pgn.Headers]]:
+    while True:
+        offset = handle.tell()
+        headers = chess.pgn.read_headers(handle)
+        if headers is None:
+            return
+        yield index, offset, headers
+        index += 1
+
+# Header predicate for analyze_pgn_file(where=...); a game passes when every
+# given criterion holds. Elo ranges are (low, high) with None for an open end
+# and reject games without a rating. `eco` lists codes, prefixes ("B") or
+# ranges ("B20-B99"); `time_control` lists exact values; `event` matches a
+# substring, ignoring case. Dates are "YYYY.MM.DD" (or "YYYY-MM-DD"); an
+# unknown month or day counts as the start of the year or month.
+def header_filter(white_elo: Optional[Tuple[Optional[int], Optional[int]]] = None,
+                  black_elo: Optional[Tuple[Optional[int], Optional[int]]] = None,
+                  eco: Optional[Sequence[str]] = None, time_control: Optional[Sequence[str]] = None,
+                  event: Optional[str] = None, date_from: Optional[str] = None,
+                  date_to: Optional[str] = None) -> Callable[[chess.pgn.Headers], bool]:
+    eco = [eco] if isinstance(eco, str) else eco
+    time_control = [time_control] if isinstance(time_control, str) else time_control
+    date_from = _pgn_date(date_from) if date_from else None
+    date_to = _pgn_date(date_to) if date_to else None
+
+    def accept(headers: chess.pgn.Headers) -> bool:
+        if white_elo and not _in_range(_elo(headers.get("WhiteElo")), white_elo):
+            return False
+        if black_elo and not _in_range(_elo(headers.get("BlackElo")), black_elo):
+            return False
+        if eco and not any(_eco_matches(headers.get("ECO", "").upper(), spec.upper()) for spec in eco):
+            return False
+        if time_control and headers.get("TimeControl") not in time_control:
+            return False
+        if event and event.lower() not in headers.get("Event", "").lower():
+            return False
+        if date_from or date_to:
+            date = headers.get("Date", "????.??.??")
+            if date.startswith("?"):
+                return False
+            date = _pgn_date(date)
+            if (date_from and date < date_from) or (date_to and date > date_to):
+                return False
+        return True
+    return accept
+
+def _elo(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _in_range(value: Optional[int], bounds: Tuple[Optional[int], Optional[int]]) -> bool:
+    low, high = bounds
+    return value is not None and (low is None or value >= low) and (high is None or value <= high)
+
+def _eco_matches(code: str, spec: str) -> bool:
+    if "-" in spec:
+        low, high = spec.split("-", 1)
+        return len(code) == 3 and low <= code <= high
+    return bool(code) and code.startswith(spec)
+
+# comparable form of a PGN date
+def _pgn_date(text: str) -> str:
+    return text.replace("-", ".").replace("??", "01")
+
+# Each worker process owns one engine for its whole lifetime
+_worker_engine: Optional[Engine] = None
+
+def _init_worker(engine_path: str, threads: Optional[int], hash_mb: Optional[int], cache_path: Optional[str]):
+    global _worker_engine
+    cache = EvalCache(cache_path) if cache_path else None
+    _worker_engine = Engine(engine_path, threads=threads, hash_mb=hash_mb, cache=cache).start()
+    Finalize(None, _worker_engine.stop, exitpriority=10)
+
+def _analyze_at(pgn_path: str, index: int, offset: int, options: Dict) -> Dict:
+    from .analysis import analyze_game  # avoid circular imports
+    record: Dict = {"index": index, "offset": offset}
+    cache = _worker_engine.cache
+    before = cache.stats() if cache else None
+    try:
+        with open(pgn_path, encoding="utf-8", errors="ignore") as f:
+            f.seek(offset)
+            game = chess.pgn.read_game(f)
+        record["headers"] = {k: game.headers[k] for k in RECORD_HEADERS if k in game.headers}
+        record["moves_hash"] = moves_hash(game)
+        record["results"] = analyze_game(game, engine=_worker_engine, progress=False, **options)
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    if cache:
+        after = cache.stats()
+        record["cache"] = {k: after[k] - before[k] for k in after}
+    return record
+
+# Identifies a game's content: start position and move list
+def moves_hash(game: chess.pgn.Game) -> str:
+    text = game.board().fen() + " " + " ".join(m.uci() for m in game.mainline_moves())
+    return hashlib.sha1(text.encode()).hexdigest()
+
+# Fingerprint of a game's record headers, checked for games never parsed
+def _headers_hash(headers: chess.pgn.Headers) -> str:
+    text = json.dumps({k: headers[k] for k in RECORD_HEADERS if k in headers}, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+# Games recorded in a checkpoint file: index -> latest entry, one of
+#   {"index", "offset", "moves_hash"}                  analyzed
+#   {"index", "offset", "headers_hash", "skipped": true} rejected by `where`
+#   {"index", "offset", "failed": true}                 failed, retried on restart
+# A line cut short by a crash is ignored.
+def read_checkpoint(path) -> Dict[int, Dict]:
+    done: Dict[int, Dict] = {}
+    if not Path(path).exists():
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                index, _ = int(entry["index"]), int(entry["offset"])
+            except (ValueError, KeyError, TypeError):
+                continue
+            done[index] = entry
+    return done
+
+# Append handle on a checkpoint file; a line cut short by a crash is ended
+# first so the next entry starts on a line of its own
+def _open_checkpoint(path) -> TextIO:
+    torn = False
+    if Path(path).exists() and Path(path).stat().st_size:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            torn = f.read(1) != b"\n"
+    handle = open(path, "a", encoding="utf-8")
+    if torn:
+        handle.write("\n")
+    return handle
+
+# Position `handle` just past the last game of the checkpointed prefix
+# (games 0..n-1 all have an entry) and return n. That game is re-read (its
+# headers, when it was skipped) to check the checkpoint still matches the file.
+def _seek_watermark(handle: TextIO, done: Dict[int, Dict]) -> int:
+    n = 0
+    while n in done:
+        n += 1
+    if n == 0:
+        return 0
+    entry = done[n - 1]
+    handle.seek(entry["offset"])
+    if "moves_hash" in entry:
+        game = chess.pgn.read_game(handle)
+        ok = game is not None and moves_hash(game) == entry["moves_hash"]
+    elif "headers_hash" in entry:
+        headers = chess.pgn.read_headers(handle)
+        ok = headers is not None and _headers_hash(headers) == entry["headers_hash"]
+    else:
+        ok = chess.pgn.skip_game(handle)
+    if not ok:
+        raise ValueError(f"Checkpoint does not match {handle.name} at game {n - 1}")
+    return n
+
+# (index, offset) of the games left to analyze: the failed games of the
+# checkpointed prefix, then every game after it that has no entry (or a
+# failed one) and passes `where`. Rejected games are passed to `skip`.
+def _games_to_run(handle: TextIO, done: Dict[int, Dict],
+                  where: Optional[Callable[[chess.pgn.Headers], bool]],
+                  skip: Callable[[int, int, chess.pgn.Headers], None]) -> Iterator[Tuple[int, int]]:
+    start = _seek_watermark(handle, done)
+    for index in sorted(done):
+        if index < start and done[index].get("failed"):
+            yield index, done[index]["offset"]
+    for index, offset, headers in iter_game_offsets(handle, start):
+        entry = done.get(index)
+        if entry and entry["offset"] == offset and not entry.get("failed"):
+            continue
+        if where and not where(headers):
+            skip(index, offset, headers)
+            continue
+        yield index, offset
+
+# flush, and fsync when the handle is a real file
+def _sync(handle: TextIO):
+    handle.flush()
+    try:
+        os.fsync(handle.fileno())
+    except (OSError, AttributeError, ValueError):
+        pass
+
+# Analyze every game of a PGN file on `jobs` worker processes, writing one
+# JSON line per game as soon as it completes (not in file order).
+# At most `jobs * 2` games are in flight, so memory does not grow with the file.
+# With `checkpoint`, every game written to `out` is also appended to that file
+# (index, offset, moves hash); a restarted job seeks past the completed prefix
+# and skips the games finished after it, so `out` should be appended to.
+# Failed and filtered-out games are checkpointed too, so the prefix keeps
+# moving; failed ones are retried on restart. A crash between the two writes
+# can repeat a game's record, never lose it. A changed `where` needs a fresh
+# checkpoint.
+# With `dedup`, games are read in chunks of DEDUP_CHUNK and each chunk goes
+# through analyze_games on a pool of `jobs` engines, so a position shared by
+# several games is searched once; records are then written in file order.
+# `where` (see header_filter) selects games from their headers alone; the
+# move text of a rejected game is skipped without being parsed. Indexes stay
+# the games' positions in the file.
+# Extra keyword options are passed on to analyze_game (analyze_games).
+def analyze_pgn_file(pgn_path, out: TextIO = sys.stdout, jobs: int = 1, threads: Optional[int] = None,
+                     hash_mb: Optional[int] = None, engine_path=STOCKFISH_PATH,
+                     cache_path=None, checkpoint=None, dedup: bool = False,
+                     where: Optional[Callable[[chess.pgn.Headers], bool]] = None, **options) -> int:
+    pgn_path = str(Path(pgn_path))
+    jobs = max(1, jobs)
+    threads, hash_mb = engine_config(jobs, threads, hash_mb)
+    max_in_flight = jobs * 2
+    finished_before = read_checkpoint(checkpoint) if checkpoint else {}
+    ckpt = _open_checkpoint(checkpoint) if checkpoint else None
+    done = 0
+
+    def write(record):
+        nonlocal done
+        out.write(json.dumps(record) + "\n")
+        if ckpt:
+            _sync(out)
+        else:
+            out.flush()
+        if ckpt:
+            entry = {k: record[k] for k in ("index", "offset")}
+            if "error" in record:
+                entry["failed"] = True
+            else:
+                entry["moves_hash"] = record["moves_hash"]
+            ckpt.write(json.dumps(entry) + "\n")
+            _sync(ckpt)
+        done += 1
+
+    # not synced: a skip lost in a crash only means rescanning those headers
+    def skip(index, offset, headers):
+        if ckpt:
+            entry = {"index": index, "offset": offset, "headers_hash": _headers_hash(headers), "skipped": True}
+            ckpt.write(json.dumps(entry) + "\n")
+
+    def drain(pending, block_until):
+        while len(pending) > block_until:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                pending.discard(fut)
+                write(fut.result())
+
+    try:
+        with open(pgn_path, encoding="utf-8", errors="ignore") as f:
+            games = _games_to_run(f, finished_before, where, skip)
+            if dedup:
+                _analyze_deduped(pgn_path, games, write, jobs, threads, hash_mb, engine_path, cache_path, options)
+                return done
+            with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                     initargs=(str(engine_path), threads, hash_mb,
+                                               str(cache_path) if cache_path else None)) as ex:
+                pending = set()
+                for index, offset in games:
+                    pending.add(ex.submit(_analyze_at, pgn_path, index, offset, options))
+                    drain(pending, max_in_flight - 1)
+                drain(pending, 0)
+    finally:
+        if ckpt:
+            ckpt.close()
+    return done
+
+# analyze_pgn_file(dedup=True): one engine pool in this process, games read
+# and analyzed DEDUP_CHUNK at a time. A game that fails to load gets an error
+# record; an engine failure fails its whole chunk.
+def _analyze_deduped(pgn_path: str, games: Iterator[Tuple[int, int]], write, jobs: int,
+                     threads: Optional[int], hash_mb: Optional[int], engine_path, cache_path, options: Dict):
+    from .analysis import analyze_games  # avoid circular imports
+    unsupported = sorted(set(options) - set(DEDUP_OPTIONS))
+    if unsupported:
+        raise ValueError(f"Not available with dedup: {', '.join(unsupported)}")
+    cache = EvalCache(cache_path) if cache_path else None
+    pool = EnginePool(size=jobs, threads=threads, hash_mb=hash_mb, path=engine_path, cache=cache)
+
+    def run(chunk, games_file):
+        records, games = [], []
+        for index, offset in chunk:
+            record: Dict = {"index": index, "offset": offset}
+            try:
+                games_file.seek(offset)
+                game = chess.pgn.read_game(games_file)
+                record["headers"] = {k: game.headers[k] for k in RECORD_HEADERS if k in game.headers}
+                record["moves_hash"] = moves_hash(game)
+                games.append(game)
+            except Exception as e:
+                record["error"] = f"{type(e).__name__}: {e}"
+            records.append(record)
+        try:
+            results = iter(analyze_games(games, pool=pool, progress=False, **options))
+            error = None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        for record in records:
+            if "error" not in record:
+                if error:
+                    record["error"] = error
+                else:
+                    record["results"] = next(results)
+            write(record)
+
+    with pool, open(pgn_path, encoding="utf-8", errors="ignore") as games_file:
+        chunk = []
+        for index, offset in games:
+            chunk.append((index, offset))
+            if len(chunk) == DEDUP_CHUNK:
+                run(chunk, games_file)
+                chunk = []
+        if chunk:
+            run(chunk, games_file)
@@ -0,0 +1,32 @@
+# app/book.py
+from __future__ import annotations
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Union
+import chess, chess.polyglot
+
+BOOK_LABEL = "Book"
+
+# Readers are memory-mapped and shared by every game of the process
+@lru_cache(maxsize=None)
+def open_book(path: str) -> chess.polyglot.MemoryMappedReader:
+    return chess.polyglot.open_reader(path)
+
+def as_reader(book: Union[str, Path, chess.polyglot.MemoryMappedReader]) -> chess.polyglot.MemoryMappedReader:
+    if isinstance(book, (str, Path)):
+        return open_book(str(Path(book)))
+    return book
+
+def is_book_move(reader: chess.polyglot.MemoryMappedReader, board: chess.Board, move: chess.Move) -> bool:
+    return any(entry.move == move for entry in reader.find_all(board))
+
+# Number of leading mainline moves that are all in the book
+def book_prefix(reader: chess.polyglot.MemoryMappedReader, board: chess.Board, moves: List[chess.Move]) -> int:
+    board = board.copy()
+    n = 0
+    for move in moves:
+        if not is_book_move(reader, board, move):
+            break
+        board.push(move)
+        n += 1
+    return n
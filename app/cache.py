@@ -0,0 +1,223 @@
+# app/cache.py
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+import chess, chess.engine, chess.pgn, chess.polyglot
+
+# Size bound of a GameCache; bump GAME_CACHE_VERSION whenever the result
+# format or the classification changes, so stale games are never served
+GAME_CACHE_MB = 256
+GAME_CACHE_VERSION = 1
+
+# On-disk evaluation cache shared by every engine, thread and worker process.
+# Rows are keyed by Zobrist hash + engine id + search settings; SQLite in WAL
+# mode lets concurrent processes read while one of them writes.
+# A stored search serves any request it dominates (depth and MultiPV both >=).
+class EvalCache:
+    def __init__(self, path):
+        self.path = str(Path(path))
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+
+    # connections must not cross a fork, so each process opens its own
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = _connect(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS evals ("
+                " key INTEGER NOT NULL, engine TEXT NOT NULL, depth INTEGER NOT NULL,"
+                " multipv INTEGER NOT NULL, lines TEXT NOT NULL,"
+                " PRIMARY KEY (key, engine, depth, multipv))")
+            self._pid = os.getpid()
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def get(self, board: chess.Board, engine: str, depth: int, multipv: int) -> Optional[List[Dict]]:
+        with self._lock:
+            row = self._db().execute(
+                "SELECT lines FROM evals WHERE key=? AND engine=? AND depth>=? AND multipv>=?"
+                " ORDER BY depth DESC, multipv ASC LIMIT 1",
+                (_key(board), engine, depth, multipv)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return [_decode(d, board.turn) for d in json.loads(row[0])[:multipv]]
+
+    # deepest stored search shallower than `depth`, as a starting point for a deeper one
+    def hint(self, board: chess.Board, engine: str, depth: int) -> Optional[List[Dict]]:
+        with self._lock:
+            row = self._db().execute(
+                "SELECT lines FROM evals WHERE key=? AND engine=? AND depth<?"
+                " ORDER BY depth DESC, multipv DESC LIMIT 1",
+                (_key(board), engine, depth)).fetchone()
+        if row is None:
+            return None
+        return [_decode(d, board.turn) for d in json.loads(row[0])]
+
+    def put(self, board: chess.Board, engine: str, depth: int, multipv: int, lines: List[Dict]):
+        data = json.dumps([_encode(info) for info in lines])
+        key = _key(board)
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                # entries the new one dominates can never be served again
+                db.execute("DELETE FROM evals WHERE key=? AND engine=? AND depth<=? AND multipv<=?",
+                           (key, engine, depth, multipv))
+                db.execute(
+                    "INSERT OR REPLACE INTO evals (key, engine, depth, multipv, lines) VALUES (?, ?, ?, ?, ?)",
+                    (key, engine, depth, multipv, data))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    # engines and workers get their own connection from the path
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+# Finished analyses of whole games, keyed by game_key. A popular game
+# submitted again is answered without touching the engine. Once the stored
+# results outgrow max_mb, the least recently used games are evicted.
+class GameCache:
+    def __init__(self, path, max_mb: float = GAME_CACHE_MB):
+        self.path = str(Path(path))
+        self.max_mb = max_mb
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = _connect(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS games ("
+                " key TEXT PRIMARY KEY, results TEXT NOT NULL,"
+                " size INTEGER NOT NULL, used REAL NOT NULL)")
+            self._pid = os.getpid()
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def get(self, key: str) -> Optional[List[Dict]]:
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT results FROM games WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            db.execute("UPDATE games SET used=? WHERE key=?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, results: List[Dict]):
+        data = json.dumps(results)
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute("INSERT OR REPLACE INTO games (key, results, size, used) VALUES (?, ?, ?, ?)",
+                           (key, data, len(data), time.time()))
+                self._evict(db)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    # drop least recently used games until the total fits in max_mb
+    def _evict(self, db: sqlite3.Connection):
+        budget = int(self.max_mb * 1024 * 1024)
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM games").fetchone()[0]
+        if total <= budget:
+            return
+        for key, size in db.execute("SELECT key, size FROM games ORDER BY used ASC").fetchall():
+            if total <= budget:
+                break
+            db.execute("DELETE FROM games WHERE key=?", (key,))
+            total -= size
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def __getstate__(self):
+        return {"path": self.path, "max_mb": self.max_mb}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["max_mb"])
+
+# Identifies one analysis of a game: start position, mainline moves, the
+# engine build and the analysis settings (a JSON-able dict)
+def game_key(game: chess.pgn.Game, engine: str, config: Dict) -> str:
+    moves = " ".join(m.uci() for m in game.mainline_moves())
+    text = json.dumps([GAME_CACHE_VERSION, game.board().fen(), moves, engine, config], sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def _connect(path: str, schema: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(schema)
+    return conn
+
+# SQLite integers are signed 64-bit
+def _key(board: chess.Board) -> int:
+    h = chess.polyglot.zobrist_hash(board)
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+# Scores and WDL are stored relative to the side to move
+def _encode(info: Dict) -> Dict:
+    d: Dict = {}
+    if "score" in info:
+        rel = info["score"].relative
+        d["score"] = ["mate", rel.mate()] if rel.is_mate() else ["cp", rel.score()]
+    if "wdl" in info:
+        w = info["wdl"].relative
+        d["wdl"] = [w.wins, w.draws, w.losses]
+    for k in ("depth", "seldepth", "multipv", "nodes"):
+        if k in info:
+            d[k] = info[k]
+    if "pv" in info:
+        d["pv"] = [m.uci() for m in info["pv"]]
+    return d
+
+def _decode(d: Dict, turn: chess.Color) -> Dict:
+    info: Dict = {}
+    if "score" in d:
+        kind, value = d["score"]
+        score = chess.engine.Mate(value) if kind == "mate" else chess.engine.Cp(value)
+        info["score"] = chess.engine.PovScore(score, turn)
+    if "wdl" in d:
+        info["wdl"] = chess.engine.PovWdl(chess.engine.Wdl(*d["wdl"]), turn)
+    for k in ("depth", "seldepth", "multipv", "nodes"):
+        if k in d:
+            info[k] = d[k]
+    if "pv" in d:
+        info["pv"] = [chess.Move.from_uci(u) for u in d["pv"]]
+    return info
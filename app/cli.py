@@ -1,6 +1,10 @@
 # app/cli.py
+import argparse
 from pathlib import Path
-from .analysis import analyze_pgn_text, format_results
+import chess.engine
+from .analysis import analyze_game_iter, iter_format_results, read_first_game
+from .cache import EvalCache, GameCache
+from .engine import Engine
 
 TEST_PGN = """[Event "Live Chess"]
 [Site "Chess.com"]
@@ -22,16 +26,104 @@ TEST_PGN = """[Event "Live Chess"]
 Qf4 15. Qe3 Qd6 16. Qe4 f5 17. Qh4 Nc6 18. Bd3 Nxd4 19. g4 Nf3+ 20. Kg2 Nxh4+
 0-1"""
 
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(description="Review chess games with Stockfish.")
+    ap.add_argument("pgn", nargs="?", help="PGN file (defaults to a built-in test game)")
+    ap.add_argument("--batch", action="store_true",
+                    help="analyze every game in the file and write one JSON line per game")
+    ap.add_argument("--jobs", type=int, default=1, help="worker processes for --batch (default: 1)")
+    ap.add_argument("--out", help="output file for --batch (default: stdout)")
+    ap.add_argument("--checkpoint", help="record finished --batch games here; a restarted job skips them "
+                                         "and appends to --out")
+    ap.add_argument("--dedup", action="store_true",
+                    help="with --batch: search positions shared between games only once")
+    ap.add_argument("--min-elo", type=int, help="with --batch: only games where both players are rated at least this")
+    ap.add_argument("--max-elo", type=int, help="with --batch: only games where both players are rated at most this")
+    ap.add_argument("--eco", help="with --batch: comma-separated ECO codes, prefixes or ranges (e.g. B20-B99,C)")
+    ap.add_argument("--time-control", help="with --batch: comma-separated TimeControl values (e.g. 600,180+2)")
+    ap.add_argument("--event", help="with --batch: only games whose Event contains this text")
+    ap.add_argument("--date-from", help="with --batch: only games played on or after this date (YYYY.MM.DD)")
+    ap.add_argument("--date-to", help="with --batch: only games played on or before this date (YYYY.MM.DD)")
+    ap.add_argument("--cache", help="on-disk position evaluation cache (SQLite file)")
+    ap.add_argument("--game-cache", help="on-disk cache of whole-game results (SQLite file, LRU-bounded)")
+    ap.add_argument("--book", help="polyglot opening book; book moves skip the engine")
+    ap.add_argument("--syzygy", help="Syzygy tablebase directory; covered endgames skip the engine")
+    ap.add_argument("--tiered", action="store_true",
+                    help="shallow pass over every move, deep re-analysis of critical moves only")
+    ap.add_argument("--searchmoves", action="store_true",
+                    help="score each played move from the position before it (UCI searchmoves)")
+    ap.add_argument("--nodes", type=int, help="search each position for this many nodes instead of a fixed depth")
+    ap.add_argument("--movetime", type=float, help="search each position for this many seconds")
+    ap.add_argument("--game-nodes", type=int, help="node budget per game, shared out by position complexity")
+    ap.add_argument("--game-time", type=float, help="time budget per game in seconds, shared out like --game-nodes")
+    ap.add_argument("--trust-pgn-evals", type=int, metavar="DEPTH",
+                    help="reuse embedded [%%eval] comments searched at least DEPTH deep (0 trusts all)")
+    return ap
+
 def main(argv=None):
     import sys
-    argv = argv or sys.argv[1:]
-    if argv:
-        p = Path(argv[0])
+    ap = build_parser()
+    args = ap.parse_args(sys.argv[1:] if argv is None else argv)
+    if args.dedup:
+        # per-game settings that the cross-game planner cannot honour
+        clashes = [flag for flag, value in (("--tiered", args.tiered), ("--searchmoves", args.searchmoves),
+                                            ("--game-nodes", args.game_nodes), ("--game-time", args.game_time),
+                                            ("--game-cache", args.game_cache)) if value]
+        if not args.batch:
+            ap.error("--dedup needs --batch")
+        if clashes:
+            ap.error(f"--dedup cannot be combined with {', '.join(clashes)}")
+    options = {}
+    if args.book:
+        options["book"] = args.book
+    if args.syzygy:
+        options["tablebase"] = args.syzygy
+    if args.tiered:
+        options["tiered"] = True
+    if args.searchmoves:
+        options["searchmoves"] = True
+    if args.nodes or args.movetime:
+        options["limit"] = chess.engine.Limit(nodes=args.nodes, time=args.movetime)
+    if args.game_nodes or args.game_time:
+        options["budget"] = chess.engine.Limit(nodes=args.game_nodes, time=args.game_time)
+    if args.trust_pgn_evals is not None:
+        options["pgn_eval_depth"] = args.trust_pgn_evals
+    if args.game_cache:
+        options["game_cache"] = GameCache(args.game_cache)
+    if args.batch:
+        if not args.pgn:
+            raise SystemExit("--batch needs a PGN file")
+        from .batch import analyze_pgn_file, header_filter
+        where = None
+        if any(v is not None for v in (args.min_elo, args.max_elo, args.eco, args.time_control,
+                                       args.event, args.date_from, args.date_to)):
+            elo = (args.min_elo, args.max_elo) if args.min_elo is not None or args.max_elo is not None else None
+            where = header_filter(white_elo=elo, black_elo=elo,
+                                  eco=args.eco.split(",") if args.eco else None,
+                                  time_control=args.time_control.split(",") if args.time_control else None,
+                                  event=args.event, date_from=args.date_from, date_to=args.date_to)
+        mode = "a" if args.checkpoint else "w"
+        out = open(args.out, mode, encoding="utf-8") if args.out else sys.stdout
+        try:
+            n = analyze_pgn_file(args.pgn, out=out, jobs=args.jobs, cache_path=args.cache,
+                                 checkpoint=args.checkpoint, dedup=args.dedup, where=where, **options)
+        finally:
+            if args.out:
+                out.close()
+        print(f"Analyzed {n} games from: {args.pgn}", file=sys.stderr)
+        return
+    if args.pgn:
+        p = Path(args.pgn)
         pgn = p.read_text(encoding="utf-8", errors="ignore")
         print(f"Loaded PGN from: {p}")
     else:
         pgn = TEST_PGN
         print("Using built-in test game.")
-    results, game = analyze_pgn_text(pgn)
-    print(format_results(results, game))
-
+    game = read_first_game(pgn)
+    cache = EvalCache(args.cache) if args.cache else None
+    with Engine(cache=cache) as eng:
+        # print each move as soon as it is classified
+        for line in iter_format_results(analyze_game_iter(game, engine=eng, progress=False, **options), game):
+            print(line, flush=True)
+    if cache:
+        print(f"Eval cache: {cache.stats()['hits']} hits, {cache.stats()['misses']} misses")
@@ -0,0 +1,96 @@
+# app/coalesce.py
+from __future__ import annotations
+import asyncio
+import inspect
+from typing import AsyncIterator, Dict, List, Optional
+import chess.pgn
+from .analysis import analysis_key, analyze_game_aiter, analyze_game_iter
+
+# Options that choose what a run uses rather than what it produces
+RUNTIME_OPTIONS = ("engine", "pool", "parallel", "progress", "game_cache")
+
+# Result-shaping settings at their defaults, so a request leaving one out
+# matches a request spelling it out
+_DEFAULT_SETTINGS = {name: p.default for name, p in inspect.signature(analyze_game_iter).parameters.items()
+                     if p.default is not inspect.Parameter.empty and name not in RUNTIME_OPTIONS}
+
+# One running analysis and everything it has produced so far
+class _Flight:
+    def __init__(self):
+        self.results: List[Dict] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+# Front end for bursts of identical review requests. The first request for a
+# game and settings starts the analysis; identical requests arriving while it
+# runs attach to it instead of starting their own. Every caller gets the whole
+# per-ply stream: the plies already done at once, then the rest as they come.
+# Options given here apply to every request (typically pool=...).
+class AnalysisCoalescer:
+    def __init__(self, **options):
+        self.options = {"progress": False, **options}
+        self.started = 0
+        self.joined = 0
+        self._flights: Dict[str, _Flight] = {}
+
+    async def analyze(self, game: chess.pgn.Game, **options) -> AsyncIterator[Dict]:
+        options = {**self.options, **options}
+        key = _request_key(game, options)
+        if key is None:
+            async for result in analyze_game_aiter(game, **options):
+                yield result
+            return
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.ensure_future(self._run(key, flight, game, options))
+            self.started += 1
+        else:
+            self.joined += 1
+
+        seen = 0
+        while True:
+            async with flight.changed:
+                await flight.changed.wait_for(lambda: len(flight.results) > seen or flight.done)
+            while seen < len(flight.results):
+                # callers share the run, not the dicts
+                yield dict(flight.results[seen])
+                seen += 1
+            if flight.done and seen == len(flight.results):
+                if flight.error is not None:
+                    raise flight.error
+                return
+
+    async def analyze_all(self, game: chess.pgn.Game, **options) -> List[Dict]:
+        return [result async for result in self.analyze(game, **options)]
+
+    # in-flight runs and how many requests started or joined one
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": len(self._flights), "started": self.started, "joined": self.joined}
+
+    # Runs to the end even if every caller leaves, so the game cache (when
+    # configured) still gets the result. Once done, the next identical request
+    # starts afresh.
+    async def _run(self, key: str, flight: _Flight, game: chess.pgn.Game, options: Dict):
+        try:
+            async for result in analyze_game_aiter(game, **options):
+                flight.results.append(result)
+                async with flight.changed:
+                    flight.changed.notify_all()
+        except asyncio.CancelledError:
+            flight.error = RuntimeError("analysis was cancelled")
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            del self._flights[key]
+            async with flight.changed:
+                flight.changed.notify_all()
+
+def _request_key(game: chess.pgn.Game, options: Dict) -> Optional[str]:
+    settings = {**_DEFAULT_SETTINGS, **{k: v for k, v in options.items() if k not in RUNTIME_OPTIONS}}
+    return analysis_key(game, options.get("engine"), options.get("pool"), **settings)
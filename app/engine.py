@@ -1,59 +1,386 @@
 # app/engine.py
 from __future__ import annotations
-from .paths import DEP_PATH, STOCKFISH_PATH
+from pathlib import Path
+import asyncio
+import sys
+import time
+from .paths import DEP_PATH, STOCKFISH_DIR, STOCKFISH_PATH
 from typing import Optional, List, Tuple
-from .paths import STOCKFISH_PATH
+from .native import ensure_stockfish
+from .cache import EvalCache
+from .hardware import engine_config
 import chess, chess.engine
 
-ENGINE_OPTS = {"Threads": 8, "Hash": 256, "UCI_ShowWDL": True}
+# Threads and Hash are derived from the machine, see hardware.engine_config
+ENGINE_OPTS = {"UCI_ShowWDL": True}
 DEFAULT_DEPTH = 16
 
-class Engine:
-    def __init__(self, path=STOCKFISH_PATH):
+# Supervision: a search that outlives SEARCH_TIMEOUT seconds (on top of its
+# own time limit) counts as a hang. A dead or hung engine is respawned and the
+# position retried SEARCH_RETRIES times; after BREAKER_THRESHOLD positions
+# fail in a row, calls fail fast for BREAKER_COOLDOWN seconds.
+SEARCH_TIMEOUT = 300.0
+SEARCH_RETRIES = 2
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 30.0
+
+# Engine process that could not answer a search even after respawning
+class EngineFailure(Exception):
+    pass
+
+ENGINE_FAILURES = (chess.engine.EngineTerminatedError, TimeoutError, asyncio.TimeoutError)
+
+# Consecutive-failure circuit breaker shared by Engine and AsyncEngine
+class _Breaker:
+    failures = 0
+    failed_at = 0.0
+
+    def _check_breaker(self):
+        if self.failures >= BREAKER_THRESHOLD and time.monotonic() - self.failed_at < BREAKER_COOLDOWN:
+            raise EngineFailure(f"Engine {self.path} is failing ({self.failures} positions in a row), "
+                                f"not retrying for {BREAKER_COOLDOWN:.0f}s")
+
+    def _record_success(self):
+        self.failures = 0
+
+    def _record_failure(self, board: chess.Board, error: BaseException):
+        self.failures += 1
+        self.failed_at = time.monotonic()
+        raise EngineFailure(f"Engine {self.path} failed on {board.fen()}: "
+                            f"{type(error).__name__}: {error}") from error
+
+# Seconds to wait for one search: its own time limit plus the watchdog margin
+def _call_timeout(limit: chess.engine.Limit, timeout: Optional[float]) -> Optional[float]:
+    if timeout is None:
+        return None
+    return timeout + (limit.time or 0)
+
+# Await an engine command under the watchdog. A hung engine never answers the
+# "stop" a cancelled command would send, so the process is killed instead:
+# the command then fails as terminated and TimeoutError is raised.
+async def _watched(coro, timeout: Optional[float], transport):
+    task = asyncio.ensure_future(coro)
+    done, _ = await asyncio.wait({task}, timeout=timeout)
+    if not done:
+        transport.close()
+        try:
+            await task
+        except chess.engine.EngineTerminatedError:
+            pass
+        raise TimeoutError(f"no answer within {timeout:.0f}s")
+    return task.result()
+
+# Options for a standalone engine; pools size their engines themselves
+def engine_options(threads: Optional[int] = None, hash_mb: Optional[int] = None) -> dict:
+    threads, hash_mb = engine_config(1, threads, hash_mb)
+    return {"Threads": threads, "Hash": hash_mb, **ENGINE_OPTS}
+
+class Engine(_Breaker):
+    def __init__(self, path=STOCKFISH_PATH, threads: Optional[int] = None, hash_mb: Optional[int] = None,
+                 cache: Optional[EvalCache] = None, timeout: Optional[float] = SEARCH_TIMEOUT,
+                 retries: int = SEARCH_RETRIES):
         self.path = str(path)
+        self.cache = cache
+        self.name = ""
+        self.options = engine_options(threads, hash_mb)
+        self.timeout = timeout
+        self.retries = retries
         self.proc: Optional[chess.engine.SimpleEngine] = None
 
     def start(self):
-        if not STOCKFISH_PATH.exists():
-            raise FileNotFoundError(f"Stockfish not found at {STOCKFISH_PATH}")
+        if not Path(self.path).exists() and self.path == str(STOCKFISH_PATH):
+            # no native binary cached yet: build one from the bundled sources
+            self.path = str(ensure_stockfish(STOCKFISH_DIR))
+        if not Path(self.path).exists():
+            raise FileNotFoundError(f"Stockfish not found at {self.path}")
         self.proc = chess.engine.SimpleEngine.popen_uci(self.path)
         try:
-            self.proc.configure(ENGINE_OPTS)
+            self.proc.configure(self.options)
         except chess.engine.EngineError:
             # Retry without WDL if unsupported
-            safe = {k:v for k,v in ENGINE_OPTS.items() if k != "UCI_ShowWDL"}
+            safe = {k:v for k,v in self.options.items() if k != "UCI_ShowWDL"}
             self.proc.configure(safe)
+        # engine version is part of the cache key
+        self.name = self.proc.id.get("name", Path(self.path).name)
         return self
 
     def stop(self):
         if self.proc:
             try:
                 self.proc.quit()
+            except Exception:
+                # process already dead, just release the transport
+                self.proc.close()
             finally:
                 self.proc = None
 
+    def restart(self):
+        self.stop()
+        return self.start()
+
+    # drop a dead or hung process without waiting for it to quit
+    def _kill(self):
+        if self.proc:
+            try:
+                self.proc.close()
+            except Exception:
+                pass  # its event loop is already gone
+            self.proc = None
+
+    # The process died since the last search (crash, OOM kill): SimpleEngine's
+    # loop thread has exited with it, so nothing can be sent any more
+    def _exited(self) -> bool:
+        return self.proc.returncode.done() or self.proc.protocol.loop.is_closed()
+
+    # cheap liveness probe (isready/readyok round trip)
+    def is_alive(self) -> bool:
+        if not self.proc or self._exited():
+            return False
+        try:
+            self.proc.ping()
+            return True
+        except Exception:
+            return False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # cached multipv search, engine errors propagate
+    # `game` identifies the game being walked: the engine keeps its hash across
+    # searches of the same game and gets ucinewgame when the key changes.
+    # `root_moves` restricts the search to those moves (UCI searchmoves);
+    # restricted searches bypass the cache.
+    def _search(self, board: chess.Board, limit: chess.engine.Limit, multipv: int, game: object = None,
+                root_moves: Optional[List[chess.Move]] = None) -> List[dict]:
+        cache = None if root_moves else self.cache
+        lines, hint = _cache_lookup(cache, self.name, board, limit, multipv)
+        if lines:
+            return lines
+        try:
+            res = self._supervised(board, limit, multipv, game, root_moves)
+        except Exception as e:
+            return _hint_or_raise(hint, board, limit, multipv, e)
+        _cache_store(cache, self.name, board, limit, multipv, res)
+        return res
+
+    # One search under the watchdog: a dead or hung engine is respawned and
+    # the search retried; when retries run out EngineFailure is raised
+    def _supervised(self, board: chess.Board, limit: chess.engine.Limit, multipv: int, game: object,
+                    root_moves: Optional[List[chess.Move]]) -> List[dict]:
+        self._check_breaker()
+        error: BaseException = None
+        for attempt in range(self.retries + 1):
+            try:
+                if self.proc is not None and self._exited():
+                    raise chess.engine.EngineTerminatedError("engine process has exited")
+                if self.proc is None:
+                    self.start()
+                coro = _watched(
+                    self.proc.protocol.analyse(board, limit, multipv=multipv, game=game, root_moves=root_moves),
+                    _call_timeout(limit, self.timeout), self.proc.transport)
+                try:
+                    future = asyncio.run_coroutine_threadsafe(coro, self.proc.protocol.loop)
+                except RuntimeError as e:
+                    # the loop closed after the check above
+                    coro.close()
+                    raise chess.engine.EngineTerminatedError(str(e)) from e
+                res = future.result()
+            except (*ENGINE_FAILURES, OSError) as e:
+                error = e
+                print(f"[!] Engine {type(e).__name__} at {limit_dict(limit)}, respawning "
+                      f"(attempt {attempt + 1}/{self.retries + 1})", file=sys.stderr)
+                self._kill()
+                continue
+            self._record_success()
+            return res
+        self._record_failure(board, error)
+
     # single position, robust, returns raw info dict
-    def analyse_safe(self, board: chess.Board, depth: int = DEFAULT_DEPTH, multipv: int = 1):
-        assert self.proc, "Engine not started"
+    def analyse_safe(self, board: chess.Board, depth: int = DEFAULT_DEPTH, multipv: int = 1,
+                     limit: Optional[chess.engine.Limit] = None, game: object = None,
+                     root_moves: Optional[List[chess.Move]] = None):
+        assert self.name, "Engine not started"
+        limit = limit or chess.engine.Limit(depth=depth)
         try:
-            result = self.proc.analyse(board, chess.engine.Limit(depth=depth), multipv=multipv)
-            if isinstance(result, list):
-                return result[0]  # just return the top line
-            return result
+            return self._search(board, limit, multipv, game, root_moves)[0]  # just return the top line
+        except EngineFailure:
+            raise
         except Exception as e:
-            print(f"[!] Engine error at depth {depth}: {e}")
+            # the engine is alive but rejected this search
+            print(f"[!] Engine error at {limit_dict(limit)}: {e}", file=sys.stderr)
             return {"score": chess.engine.PovScore(chess.engine.Cp(0), board.turn)}
 
 
 
     # multipv best lines
-    def best_lines(self, board: chess.Board, multipv=3, depth: int = DEFAULT_DEPTH):
-        assert self.proc, "Engine not started"
+    def best_lines(self, board: chess.Board, multipv=3, depth: int = DEFAULT_DEPTH,
+                   limit: Optional[chess.engine.Limit] = None, game: object = None,
+                   root_moves: Optional[List[chess.Move]] = None):
+        assert self.name, "Engine not started"
+        limit = limit or chess.engine.Limit(depth=depth)
         try:
-            res = self.proc.analyse(board, chess.engine.Limit(depth=depth), multipv=multipv)
-            if not isinstance(res, list):
-                res = [res]
-            return res
+            return self._search(board, limit, multipv, game, root_moves)
+        except EngineFailure:
+            raise
         except Exception:
-            single = self.analyse_safe(board, depth=depth)
+            single = self.analyse_safe(board, limit=limit, game=game, root_moves=root_moves)
             return [single]
+
+# Non-None fields of a search limit, e.g. {"nodes": 200000}
+def limit_dict(limit: chess.engine.Limit) -> dict:
+    return {k: v for k, v in (("depth", limit.depth), ("nodes", limit.nodes), ("time", limit.time)) if v is not None}
+
+# Only pure depth limits can be answered from the cache (node and time limited
+# results are still stored, under the depth they reached)
+def _cache_lookup(cache: Optional[EvalCache], name: str, board: chess.Board,
+                  limit: chess.engine.Limit, multipv: int):
+    if not cache or limit.depth is None or limit.nodes is not None or limit.time is not None:
+        return None, None
+    lines = cache.get(board, name, limit.depth, multipv)
+    if lines:
+        return lines, None
+    return None, cache.hint(board, name, limit.depth)
+
+def _cache_store(cache: Optional[EvalCache], name: str, board: chess.Board,
+                 limit: chess.engine.Limit, multipv: int, res: List[dict]):
+    if not cache or not res:
+        return
+    depth = limit.depth if limit.nodes is None and limit.time is None else res[0].get("depth")
+    if depth:
+        cache.put(board, name, depth, multipv, res)
+
+# a shallower cached search beats no answer at all
+def _hint_or_raise(hint: Optional[List[dict]], board: chess.Board, limit: chess.engine.Limit,
+                   multipv: int, e: Exception) -> List[dict]:
+    if hint and len(hint) >= min(multipv, board.legal_moves.count()):
+        print(f"[!] Engine error at {limit_dict(limit)}, using cached depth {hint[0].get('depth')}: {e}",
+              file=sys.stderr)
+        return hint[:multipv]
+    raise e
+
+
+# Same interface as Engine, built directly on chess.engine's asyncio protocol:
+# no background thread per engine, so one event loop can drive many of them.
+# Cache lookups are local SQLite reads and stay synchronous.
+class AsyncEngine(_Breaker):
+    def __init__(self, path=STOCKFISH_PATH, threads: Optional[int] = None, hash_mb: Optional[int] = None,
+                 cache: Optional[EvalCache] = None, timeout: Optional[float] = SEARCH_TIMEOUT,
+                 retries: int = SEARCH_RETRIES):
+        self.path = str(path)
+        self.cache = cache
+        self.name = ""
+        self.options = engine_options(threads, hash_mb)
+        self.timeout = timeout
+        self.retries = retries
+        self.transport = None
+        self.protocol: Optional[chess.engine.UciProtocol] = None
+
+    async def start(self):
+        if not Path(self.path).exists() and self.path == str(STOCKFISH_PATH):
+            self.path = str(await asyncio.to_thread(ensure_stockfish, STOCKFISH_DIR))
+        if not Path(self.path).exists():
+            raise FileNotFoundError(f"Stockfish not found at {self.path}")
+        self.transport, self.protocol = await chess.engine.popen_uci(self.path)
+        try:
+            await self.protocol.configure(self.options)
+        except chess.engine.EngineError:
+            # Retry without WDL if unsupported
+            safe = {k:v for k,v in self.options.items() if k != "UCI_ShowWDL"}
+            await self.protocol.configure(safe)
+        self.name = self.protocol.id.get("name", Path(self.path).name)
+        return self
+
+    async def stop(self):
+        if self.protocol:
+            try:
+                await self.protocol.quit()
+            except Exception:
+                self.transport.close()
+            finally:
+                self.transport, self.protocol = None, None
+
+    async def restart(self):
+        await self.stop()
+        return await self.start()
+
+    async def _kill(self):
+        if self.transport:
+            self.transport.close()
+            self.transport, self.protocol = None, None
+
+    async def is_alive(self) -> bool:
+        if not self.protocol:
+            return False
+        try:
+            await self.protocol.ping()
+            return True
+        except Exception:
+            return False
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def _search(self, board: chess.Board, limit: chess.engine.Limit, multipv: int, game: object = None,
+                      root_moves: Optional[List[chess.Move]] = None) -> List[dict]:
+        cache = None if root_moves else self.cache
+        lines, hint = _cache_lookup(cache, self.name, board, limit, multipv)
+        if lines:
+            return lines
+        try:
+            res = await self._supervised(board, limit, multipv, game, root_moves)
+        except Exception as e:
+            return _hint_or_raise(hint, board, limit, multipv, e)
+        _cache_store(cache, self.name, board, limit, multipv, res)
+        return res
+
+    async def _supervised(self, board: chess.Board, limit: chess.engine.Limit, multipv: int, game: object,
+                          root_moves: Optional[List[chess.Move]]) -> List[dict]:
+        self._check_breaker()
+        error: BaseException = None
+        for attempt in range(self.retries + 1):
+            try:
+                if self.protocol is None:
+                    await self.start()
+                res = await _watched(
+                    self.protocol.analyse(board, limit, multipv=multipv, game=game, root_moves=root_moves),
+                    _call_timeout(limit, self.timeout), self.transport)
+            except (*ENGINE_FAILURES, OSError) as e:
+                error = e
+                print(f"[!] Engine {type(e).__name__} at {limit_dict(limit)}, respawning "
+                      f"(attempt {attempt + 1}/{self.retries + 1})", file=sys.stderr)
+                await self._kill()
+                continue
+            self._record_success()
+            return res
+        self._record_failure(board, error)
+
+    async def analyse_safe(self, board: chess.Board, depth: int = DEFAULT_DEPTH, multipv: int = 1,
+                           limit: Optional[chess.engine.Limit] = None, game: object = None,
+                           root_moves: Optional[List[chess.Move]] = None):
+        assert self.name, "Engine not started"
+        limit = limit or chess.engine.Limit(depth=depth)
+        try:
+            return (await self._search(board, limit, multipv, game, root_moves))[0]
+        except EngineFailure:
+            raise
+        except Exception as e:
+            print(f"[!] Engine error at {limit_dict(limit)}: {e}", file=sys.stderr)
+            return {"score": chess.engine.PovScore(chess.engine.Cp(0), board.turn)}
+
+    async def best_lines(self, board: chess.Board, multipv=3, depth: int = DEFAULT_DEPTH,
+                         limit: Optional[chess.engine.Limit] = None, game: object = None,
+                         root_moves: Optional[List[chess.Move]] = None):
+        assert self.name, "Engine not started"
+        limit = limit or chess.engine.Limit(depth=depth)
+        try:
+            return await self._search(board, limit, multipv, game, root_moves)
+        except EngineFailure:
+            raise
+        except Exception:
+            return [await self.analyse_safe(board, limit=limit, game=game, root_moves=root_moves)]
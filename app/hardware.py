@@ -0,0 +1,44 @@
+# app/hardware.py
+from __future__ import annotations
+import os
+from typing import Optional, Tuple
+
+HASH_BUDGET_FRACTION = 0.25   # share of available memory all engines' hash may use
+MIN_HASH_MB = 16
+MAX_HASH_MB = 2048            # per engine; more rarely pays off for game review
+
+# Cores this process may run on (respects taskset/cgroup cpusets)
+def available_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return os.cpu_count() or 1
+
+# MemAvailable from /proc/meminfo, else free physical pages; None if unknown
+def available_memory_mb() -> Optional[int]:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+# Threads and Hash (MB) per engine for `engines` concurrent engines, so that
+# engines x threads stays within the allotted cores and the summed hash within
+# the memory budget. Explicit values always win.
+def engine_config(engines: int = 1, threads: Optional[int] = None, hash_mb: Optional[int] = None,
+                  memory_budget_mb: Optional[int] = None) -> Tuple[int, int]:
+    engines = max(1, engines)
+    if threads is None:
+        threads = max(1, available_cores() // engines)
+    if hash_mb is None:
+        if memory_budget_mb is None:
+            avail = available_memory_mb()
+            memory_budget_mb = int(avail * HASH_BUDGET_FRACTION) if avail else MIN_HASH_MB * engines
+        per_engine = memory_budget_mb // engines
+        hash_mb = max(MIN_HASH_MB, min(MAX_HASH_MB, per_engine - per_engine % MIN_HASH_MB))
+    return threads, hash_mb
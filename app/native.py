@@ -0,0 +1,161 @@
+# app/native.py
+from __future__ import annotations
+import os
+import platform
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from typing import List, Optional, Set
+
+# Stockfish ARCH values from fastest to most portable; a CPU that supports one
+# also runs every build after it (same order as scripts/get_native_properties.sh)
+X86_ARCHS = ["x86-64-vnni256", "x86-64-avx512", "x86-64-bmi2", "x86-64-avx2", "x86-64-sse41-popcnt", "x86-64"]
+ARM_ARCHS = ["armv8-dotprod", "armv8"]
+
+# CPU flags with "_" and "." removed, as the Makefile's detection script does
+def cpu_flags() -> Set[str]:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    return {fl.replace("_", "").replace(".", "") for fl in line.split(":", 1)[1].split()}
+    except OSError:
+        pass
+    return set()
+
+# AMD Zen 1/2 implement pext/pdep (bmi2) in microcode, which is slower than avx2
+def _is_znver_1_2() -> bool:
+    vendor = family = None
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("vendor_id"):
+                    vendor = line.split(":", 1)[1].strip()
+                elif line.startswith("cpu family"):
+                    family = line.split(":", 1)[1].strip()
+                if vendor and family:
+                    break
+    except OSError:
+        return False
+    return vendor == "AuthenticAMD" and family == "23"
+
+# Best Stockfish ARCH for this machine, or None if unknown
+def native_arch() -> Optional[str]:
+    machine = platform.machine().lower()
+    flags = cpu_flags()
+    if machine in ("x86_64", "amd64"):
+        if {"avx512vnni", "avx512dq", "avx512f", "avx512bw", "avx512vl"} <= flags:
+            return "x86-64-vnni256"
+        if {"avx512f", "avx512bw"} <= flags:
+            return "x86-64-avx512"
+        if "bmi2" in flags and not _is_znver_1_2():
+            return "x86-64-bmi2"
+        if "avx2" in flags:
+            return "x86-64-avx2"
+        if {"sse41", "popcnt"} <= flags:
+            return "x86-64-sse41-popcnt"
+        return "x86-64"
+    if machine in ("aarch64", "arm64"):
+        return "armv8-dotprod" if "asimddp" in flags else "armv8"
+    return None
+
+# The native ARCH followed by every slower build that still runs here
+def candidate_archs(arch: Optional[str] = None) -> List[str]:
+    arch = arch or native_arch()
+    for chain in (X86_ARCHS, ARM_ARCHS):
+        if arch in chain:
+            return chain[chain.index(arch):]
+    return [arch] if arch else []
+
+def _exe(name: str) -> str:
+    return name + ".exe" if sys.platform == "win32" else name
+
+def cached_binary(stockfish_dir: Path, arch: str) -> Path:
+    return stockfish_dir / "bin" / _exe(f"stockfish-{arch}")
+
+# Best Stockfish already on disk, without building anything:
+# $STOCKFISH, a cached native build, a bundled Windows build, then `stockfish`
+# on PATH. Falls back to where the native build would be cached.
+def find_stockfish(stockfish_dir: Path) -> Path:
+    env = os.environ.get("STOCKFISH")
+    if env:
+        return Path(env)
+    archs = candidate_archs()
+    for arch in archs:
+        path = cached_binary(stockfish_dir, arch)
+        if path.exists():
+            return path
+    if sys.platform == "win32":
+        for arch in archs + ["x86-64-avx2"]:
+            path = stockfish_dir / f"stockfish-windows-{arch}.exe"
+            if path.exists():
+                return path
+    on_path = shutil.which("stockfish")
+    if on_path:
+        return Path(on_path)
+    return cached_binary(stockfish_dir, archs[0] if archs else "native")
+
+# Compile the bundled sources for `arch` (profile-guided when possible) and
+# cache the binary under stockfish/bin. Concurrent callers wait for one build.
+def build_stockfish(stockfish_dir: Path, arch: str) -> Path:
+    target = cached_binary(stockfish_dir, arch)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    src = stockfish_dir / "src"
+    with open(target.parent / ".build.lock", "w") as lock:
+        try:
+            import fcntl
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        if target.exists():
+            return target
+        jobs = str(os.cpu_count() or 1)
+        print(f"[*] Building Stockfish ({arch}) from {src}, this takes a few minutes...", file=sys.stderr)
+        built = False
+        for make_target in ("profile-build", "build"):
+            if make_target == "build":
+                # a failed profile-build leaves instrumented objects behind
+                _make_clean(src)
+            proc = subprocess.run(["make", "-j", jobs, make_target, f"ARCH={arch}"], cwd=src,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            if proc.returncode == 0:
+                built = True
+                break
+            print(f"[!] make {make_target} ARCH={arch} failed: {proc.stderr.strip()[-500:]}", file=sys.stderr)
+        binary = src / _exe("stockfish")
+        try:
+            # a failed network download still links, but with an empty NNUE net
+            if not built or not _runs_bench(binary):
+                raise RuntimeError(f"Could not build a working Stockfish for {arch}")
+            tmp = target.with_suffix(".tmp")
+            shutil.copy2(binary, tmp)
+            os.replace(tmp, target)
+        finally:
+            _make_clean(src)
+    return target
+
+# objects and profile data; downloaded NNUE nets stay for the next build
+def _make_clean(src: Path):
+    subprocess.run(["make", "clean"], cwd=src, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def _runs_bench(binary: Path) -> bool:
+    try:
+        proc = subprocess.run([str(binary), "bench", "16", "1", "1"], capture_output=True, timeout=120)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return proc.returncode == 0
+
+# find_stockfish, building if nothing usable is on disk yet: the native
+# architecture first, then each slower one until a build passes the bench
+def ensure_stockfish(stockfish_dir: Path) -> Path:
+    path = find_stockfish(stockfish_dir)
+    if path.exists():
+        return path
+    if shutil.which("make") and (stockfish_dir / "src" / "Makefile").exists():
+        for arch in candidate_archs():
+            try:
+                return build_stockfish(stockfish_dir, arch)
+            except (OSError, RuntimeError) as e:
+                print(f"[!] {e}", file=sys.stderr)
+    raise FileNotFoundError(f"Stockfish not found at {path} and could not be built from {stockfish_dir / 'src'}")
@@ -7,4 +7,8 @@ DEP_PATH = ROOT / "dep"
 if str(DEP_PATH) not in sys.path:
     sys.path.insert(0, str(DEP_PATH))
 
-STOCKFISH_PATH = ROOT / "stockfish" / "stockfish-windows-x86-64-avx2.exe"
\ No newline at end of file
+from .native import find_stockfish
+
+STOCKFISH_DIR = ROOT / "stockfish"
+# best binary for this CPU/OS that is already on disk (Engine.start builds one if missing)
+STOCKFISH_PATH = find_stockfish(STOCKFISH_DIR)
@@ -0,0 +1,179 @@
+# app/pool.py
+from __future__ import annotations
+import asyncio
+import queue
+import sys
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import List, Optional
+from .paths import STOCKFISH_PATH
+from .engine import AsyncEngine, Engine
+from .cache import EvalCache
+from .hardware import engine_config
+
+DEFAULT_POOL_SIZE = 1
+
+# Sizing shared by both pools: `size` engines of engine_class, splitting cores
+# and hash budget over the pool unless given explicitly
+class _PoolConfig:
+    engine_class = Engine
+
+    def __init__(self, size: int = DEFAULT_POOL_SIZE, threads: Optional[int] = None,
+                 hash_mb: Optional[int] = None, path=STOCKFISH_PATH, cache: Optional[EvalCache] = None,
+                 memory_budget_mb: Optional[int] = None):
+        if size < 1:
+            raise ValueError("Pool size must be at least 1")
+        self.size = size
+        self.threads, self.hash_mb = engine_config(size, threads, hash_mb, memory_budget_mb)
+        self.path = path
+        self.cache = cache
+        self._init_slots()
+
+    # a new, not yet started engine for one slot
+    def _new_engine(self):
+        return self.engine_class(self.path, threads=self.threads, hash_mb=self.hash_mb, cache=self.cache)
+
+    # a dead engine is kept in its slot; the next checkout retries the restart
+    def _restart_failed(self, e: Exception):
+        print(f"[!] Engine restart failed: {e}", file=sys.stderr)
+
+# Keeps `size` warm Stockfish processes alive and lends them out per analysis.
+# A dead engine is restarted before it is handed out again.
+class EnginePool(_PoolConfig):
+    def _init_slots(self):
+        self.engines: List[Engine] = []
+        self._idle: "queue.Queue[Engine]" = queue.Queue()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.engines:
+                return self
+            try:
+                for _ in range(self.size):
+                    eng = self._new_engine().start()
+                    self.engines.append(eng)
+                    self._idle.put(eng)
+            except Exception:
+                self._stop_all()
+                raise
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._stop_all()
+
+    def _stop_all(self):
+        for eng in self.engines:
+            eng.stop()
+        self.engines = []
+        self._idle = queue.Queue()
+
+    def checkout(self, timeout: Optional[float] = None) -> Engine:
+        if not self.engines:
+            raise RuntimeError("Engine pool not started")
+        try:
+            eng = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No idle engine available") from None
+        if not eng.is_alive():
+            try:
+                eng.restart()
+            except Exception:
+                self._idle.put(eng)  # keep the slot, next checkout retries
+                raise
+        return eng
+
+    def checkin(self, eng: Engine, healthy: bool = True):
+        if not healthy:
+            try:
+                eng.restart()
+            except Exception as e:
+                self._restart_failed(e)
+        self._idle.put(eng)
+
+    @contextmanager
+    def engine(self, timeout: Optional[float] = None):
+        eng = self.checkout(timeout)
+        healthy = True
+        try:
+            yield eng
+        except BaseException:
+            healthy = eng.is_alive()
+            raise
+        finally:
+            self.checkin(eng, healthy)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+# EnginePool for AsyncEngine: a fixed fleet shared by every coroutine on one loop
+class AsyncEnginePool(_PoolConfig):
+    engine_class = AsyncEngine
+
+    def _init_slots(self):
+        self.engines: List[AsyncEngine] = []
+        self._idle: Optional["asyncio.Queue[AsyncEngine]"] = None
+
+    async def start(self):
+        if self.engines:
+            return self
+        self._idle = asyncio.Queue()
+        try:
+            self.engines = await asyncio.gather(*(self._new_engine().start() for _ in range(self.size)))
+        except Exception:
+            await self.stop()
+            raise
+        for eng in self.engines:
+            self._idle.put_nowait(eng)
+        return self
+
+    async def stop(self):
+        engines, self.engines = self.engines, []
+        await asyncio.gather(*(eng.stop() for eng in engines), return_exceptions=True)
+        self._idle = None
+
+    async def checkout(self, timeout: Optional[float] = None) -> AsyncEngine:
+        if not self.engines:
+            raise RuntimeError("Engine pool not started")
+        try:
+            eng = await asyncio.wait_for(self._idle.get(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("No idle engine available") from None
+        if not await eng.is_alive():
+            try:
+                await eng.restart()
+            except Exception:
+                self._idle.put_nowait(eng)
+                raise
+        return eng
+
+    async def checkin(self, eng: AsyncEngine, healthy: bool = True):
+        if not healthy:
+            try:
+                await eng.restart()
+            except Exception as e:
+                self._restart_failed(e)
+        self._idle.put_nowait(eng)
+
+    @asynccontextmanager
+    async def engine(self, timeout: Optional[float] = None):
+        eng = await self.checkout(timeout)
+        healthy = True
+        try:
+            yield eng
+        except BaseException:
+            healthy = await eng.is_alive()
+            raise
+        finally:
+            await self.checkin(eng, healthy)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
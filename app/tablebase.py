@@ -0,0 +1,58 @@
+# app/tablebase.py
+from __future__ import annotations
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+import chess, chess.engine, chess.syzygy
+
+# TB wins sit in the same band as engine mates (score_to_cp maps mate in n
+# to ±(10000 - n)), so a won position reaching the tables costs no cp.
+# A longer way to zero the counter costs at most TB_DTZ_CP, a tiebreak well
+# under the inaccuracy threshold.
+TB_WIN_CP = 9990
+TB_DTZ_CP = 9
+
+# Tables are opened once per process; the Tablebase keeps its own fd/mmap LRU
+@lru_cache(maxsize=None)
+def open_tablebase(path: str) -> chess.syzygy.Tablebase:
+    return chess.syzygy.open_tablebase(path)
+
+def as_tablebase(tablebase: Union[str, Path, chess.syzygy.Tablebase]) -> chess.syzygy.Tablebase:
+    if isinstance(tablebase, (str, Path)):
+        return open_tablebase(str(Path(tablebase)))
+    return tablebase
+
+# Largest piece count with a WDL table loaded ("KRPvKR" -> 5)
+@lru_cache(maxsize=None)
+def _max_pieces(tb: chess.syzygy.Tablebase) -> int:
+    return max((len(name) - 1 for name in tb.wdl), default=0)
+
+# Score for the side to move, from WDL and distance to zeroing
+def _wdl_cp(wdl: int, dtz: int) -> int:
+    if wdl == 2:
+        return TB_WIN_CP - min(abs(dtz), TB_DTZ_CP)
+    if wdl == -2:
+        return -TB_WIN_CP + min(abs(dtz), TB_DTZ_CP)
+    return 0  # draws and wins/losses spoiled by the 50-move rule
+
+# Engine-style MultiPV lines built from the tables, or None if the position is
+# not covered (too many pieces, castling rights, missing table files).
+# Among equally scored moves `prefer` (the move actually played) ranks first.
+def probe_lines(tb: chess.syzygy.Tablebase, board: chess.Board, multipv: int = 1,
+                prefer: Optional[chess.Move] = None) -> Optional[List[Dict]]:
+    if chess.popcount(board.occupied) > _max_pieces(tb) or board.castling_rights or board.is_game_over():
+        return None
+    scored = []
+    try:
+        for move in board.legal_moves:
+            board.push(move)
+            try:
+                cp = -_wdl_cp(tb.probe_wdl(board), tb.probe_dtz(board))
+            finally:
+                board.pop()
+            scored.append((cp, move))
+    except KeyError:  # MissingTableError
+        return None
+    scored.sort(key=lambda t: (t[0], t[1] == prefer), reverse=True)
+    return [{"score": chess.engine.PovScore(chess.engine.Cp(cp), board.turn), "pv": [move], "multipv": i}
+            for i, (cp, move) in enumerate(scored[:multipv], start=1)]